@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/3.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
+import datetime
 import json
 import secrets
 from pathlib import Path
@@ -67,6 +68,17 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Per-view latency and query count histograms, exposed to staff at /metrics
+
+if os.environ.get('METRICS'):
+    MIDDLEWARE.insert(0, 'recapp.middleware.MetricsMiddleware')
+
+# Requests slower than this many seconds are logged with their slowest queries (empty or none to disable)
+
+SLOW_REQUEST_THRESHOLD = os.environ.get('SLOW_REQUEST_THRESHOLD', '1').strip()
+SLOW_REQUEST_THRESHOLD = None if SLOW_REQUEST_THRESHOLD.lower() in ('', 'none') else float(SLOW_REQUEST_THRESHOLD)
+SLOW_REQUEST_QUERIES = 5
+
 ROOT_URLCONF = 'RecTester.urls'
 
 TEMPLATES = [
@@ -99,6 +111,64 @@ DATABASES = {
     }
 }
 
+# DATABASE_PROFILE=production switches to WAL journaling and immediate write transactions,
+# so runners posting results don't fail with "database is locked" while pages are read
+
+SQLITE_PRODUCTION = {
+    'ENGINE': 'RecTester.sqlite',
+    'OPTIONS': {
+        # Seconds a connection waits for another one's write lock
+        'timeout': 20,
+        'pragmas': {
+            'journal_mode': 'WAL',
+            # Durable across application crashes; only an OS crash can lose the last commits
+            'synchronous': 'NORMAL',
+            # Negative is in KiB: 64 MiB of page cache per connection
+            'cache_size': -64000,
+            'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 'MEMORY',
+        },
+        'transaction_mode': 'IMMEDIATE',
+    },
+}
+
+if os.environ.get('DATABASE_PROFILE') == 'production':
+    DATABASES['default'].update(SQLITE_PRODUCTION)
+
+# Background tasks (recapp/tasks.py). Without a broker, tasks run in the process that queues
+# them, right after the transaction that triggered them commits
+
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'memory://')
+CELERY_TASK_ALWAYS_EAGER = 'CELERY_BROKER_URL' not in os.environ
+# Raise from delay() rather than keep the error in a result nobody reads
+CELERY_TASK_EAGER_PROPAGATES = True
+CELERY_TASK_IGNORE_RESULT = True
+
+# How often a write that still finds the database locked is retried, and the first backoff in seconds
+
+DATABASE_LOCK_RETRIES = 5
+DATABASE_LOCK_BACKOFF = 0.05
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# The default is per process: with several workers, point this at a shared backend
+# (memcached, redis) so that invalidations reach every worker.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# How long cached pages are served before they are rebuilt even without writes
+
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 60))
+
+# How long one worker may spend rebuilding a cached page before another one takes over
+
+CACHE_LOCK_TIMEOUT = 30
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -160,3 +230,48 @@ REST_FRAMEWORK = {
 # Rec files upload path
 
 UPLOADS_PATH = 'uploads'
+
+# Let the front proxy send rec downloads instead of streaming them from Python:
+# None, 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd)
+
+SENDFILE_MODE = os.environ.get('SENDFILE_MODE') or None
+
+# Internal location the proxy serves UPLOADS_PATH from, for X-Accel-Redirect
+
+SENDFILE_URL = '/protected-uploads'
+
+# Verifier OS labels that every new upload is queued for
+
+VERIFIER_OS = os.environ.get('VERIFIER_OS', 'windows,mac,windows-newphys221029').split(',')
+
+# How long a runner holds a claimed job before it is handed out again
+
+JOB_LEASE_TIME = datetime.timedelta(minutes=30)
+JOB_CLAIM_LIMIT = 50
+
+# Claims of one job before it is parked, so a submission that never gets a run recorded stops
+# being handed out. Parked jobs stay in the admin, and a reverify request queues them again
+
+JOB_MAX_ATTEMPTS = 5
+
+# How far behind fresh uploads each kind of job is queued. Fixed delays rather than strict
+# priority, so re-verification and backfill move up as they wait and are never starved
+
+JOB_PRIORITY_DELAY = {
+    'fresh': datetime.timedelta(0),
+    'reverify': datetime.timedelta(hours=1),
+    'backfill': datetime.timedelta(days=1),
+}
+
+# Spacing between one uploader's queued jobs when no runner for the OS has reported a run rate
+
+JOB_SHARE_INTERVAL = datetime.timedelta(minutes=1)
+
+# Runners that haven't been in contact for this long are no longer listed, or are flagged as stalled
+
+RUNNER_LIVE_TIME = datetime.timedelta(minutes=30)
+RUNNER_STALL_TIME = datetime.timedelta(minutes=10)
+
+# Most runs a runner can post to /api/runs/bulk/ at once
+
+RUN_BATCH_LIMIT = 200
@@ -0,0 +1,31 @@
+"""
+SQLite backend tuned for several runners writing while pages are being read.
+
+Selected with DATABASE_PROFILE=production in settings. On top of Django's backend it takes
+two extra OPTIONS:
+
+- pragmas: PRAGMA name -> value, set on every new connection (WAL journaling, etc.)
+- transaction_mode: how atomic() blocks begin, IMMEDIATE by default, so that a transaction
+  takes the write lock up front and waits for it within the busy timeout. A deferred
+  transaction that reads first fails straight away with "database is locked" when it
+  later tries to write while another connection holds the lock.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        kwargs.pop('pragmas', None)
+        kwargs.pop('transaction_mode', None)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.settings_dict['OPTIONS'].get('pragmas', {}).items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict['OPTIONS'].get('transaction_mode', 'IMMEDIATE')
+        self.cursor().execute(f'BEGIN {mode}')
@@ -25,6 +25,10 @@ router = routers.DefaultRouter()
 router.register('submissions', views.SubmissionViewSet, basename='submission')
 router.register('pending_submissions/(?P<os>[a-z_0-9-]+)', views.PendingSubmissionViewSet, basename='pending_submissions')
 router.register('submissions/(?P<submission_id>[0-9]+)/runs', views.RunViewSet)
+router.register('runs', views.RunBatchViewSet, basename='run-batch')
+router.register('jobs', views.JobViewSet, basename='job')
+router.register('runners', views.RunnerViewSet, basename='runner')
+router.register('campaigns', views.CampaignViewSet)
 router.register('users', views.UserViewSet)
 router.register('groups', views.GroupViewSet)
 
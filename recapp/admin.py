@@ -1,5 +1,6 @@
+from django.conf import settings
 from django.contrib import admin
-from .models import Submission, Score
+from .models import Submission, Score, Job, Campaign
 from .templatetags.scores import score
 
 
@@ -30,3 +31,49 @@ class ScoreAdmin(admin.ModelAdmin):
 		if not item.success:
 			return ""
 		return score(item.elapsed_time)
+
+
+class ParkedFilter(admin.SimpleListFilter):
+	title = 'parked'
+	parameter_name = 'parked'
+
+	def lookups(self, request, model_admin):
+		return (('yes', 'Yes'), ('no', 'No'))
+
+	def queryset(self, request, queryset):
+		if self.value() == 'yes':
+			return queryset.filter(attempts__gte=settings.JOB_MAX_ATTEMPTS)
+		if self.value() == 'no':
+			return queryset.filter(attempts__lt=settings.JOB_MAX_ATTEMPTS)
+		return queryset
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+	list_display = ('submission', 'os', 'priority', 'attempts', 'available_date', 'id')
+	list_filter = (ParkedFilter, 'os', 'priority')
+	list_select_related = ('submission',)
+	raw_id_fields = ('submission', 'campaign', 'lease_owner', 'uploader')
+	actions = ('requeue',)
+
+	@admin.action(description='Requeue selected jobs with fresh attempts')
+	def requeue(self, request, queryset):
+		queryset.update(attempts=0)
+
+
+@admin.register(Campaign)
+class CampaignAdmin(admin.ModelAdmin):
+	list_display = ('name', 'os', 'baseline_os', 'status', 'queued', 'total', 'created_date', 'id')
+	list_filter = ('status', 'os')
+	readonly_fields = ('status', 'created_date', 'completed_date', 'position', 'total', 'queued', 'allowance', 'last_top_up')
+	actions = ('pause', 'resume')
+
+	@admin.action(description='Pause selected campaigns')
+	def pause(self, request, queryset):
+		for campaign in queryset.filter(status=Campaign.Status.ACTIVE):
+			campaign.pause()
+
+	@admin.action(description='Resume selected campaigns')
+	def resume(self, request, queryset):
+		for campaign in queryset.filter(status=Campaign.Status.PAUSED):
+			campaign.resume()
@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+GENERATION_KEY = 'recapp:generation'
+
+
+def generation():
+    """The current data generation, bumped by invalidate() whenever submissions or runs change."""
+    value = cache.get(GENERATION_KEY)
+    if value is None:
+        cache.add(GENERATION_KEY, 0, None)
+        value = cache.get(GENERATION_KEY, 0)
+    return value
+
+
+def invalidate():
+    """Marks everything stored with cached() as stale."""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, 1, None)
+
+
+def cached(key, build, ttl=None):
+    """
+    Returns build(), cached under key until invalidate() is called or ttl seconds pass.
+
+    Only one worker rebuilds a stale value at a time. The others keep serving the stale
+    copy meanwhile, or wait for the rebuild if there is no copy at all.
+    """
+    if ttl is None:
+        ttl = settings.CACHE_TTL
+    key = f'recapp:{key}'
+    lock_key = f'{key}:lock'
+
+    current = generation()
+    entry = cache.get(key)
+    if entry is not None and entry['generation'] == current and entry['expires'] > time.time():
+        return entry['value']
+
+    if cache.add(lock_key, True, settings.CACHE_LOCK_TIMEOUT):
+        try:
+            value = build()
+            # Kept past its ttl so there is a stale copy to serve during the next rebuild
+            cache.set(key, {'generation': current, 'expires': time.time() + ttl, 'value': value}, None)
+            return value
+        finally:
+            cache.delete(lock_key)
+
+    if entry is not None:
+        return entry['value']
+
+    deadline = time.time() + settings.CACHE_LOCK_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry['value']
+    return build()
@@ -0,0 +1,157 @@
+import csv
+import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils.dateparse import parse_date, parse_datetime
+
+from recapp.models import Submission, Run
+
+SUBMISSION_COLUMNS = ['id', 'name', 'hash', 'upload_date', 'is_tas', 'expected_time', 'best_score_time']
+RUN_COLUMNS = ['id', 'os', 'run_date', 'error', 'error_kind', 'duration']
+SCORE_COLUMNS = ['success', 'mission', 'level_name', 'score_time', 'elapsed_time', 'bonus_time', 'gem_count',
+                 'gem_total', 'fps', 'frames_count', 'frames_time', 'desync']
+
+# Rows fetched per query round trip
+CHUNK_SIZE = 2000
+# Bytes collected before a chunk is handed to the response
+BUFFER_SIZE = 64 * 1024
+
+
+def parse_when(value):
+    """A date or datetime from an ISO 8601 string, or ValueError."""
+    when = parse_datetime(value) or parse_date(value)
+    if when is None:
+        raise ValueError(f'Not a date: {value}')
+    return when
+
+
+def parse_filters(params):
+    """Keyword arguments for submissions_with_runs from the os, level, from, to and success strings in params."""
+    filters = {}
+    if params.get('os'):
+        filters['oses'] = params['os'].split(',')
+    if params.get('level'):
+        filters['level'] = params['level']
+    if params.get('from'):
+        filters['since'] = parse_when(params['from'])
+    if params.get('to'):
+        filters['until'] = parse_when(params['to'])
+    if params.get('success'):
+        if params['success'].lower() not in ('true', 'false', '1', '0'):
+            raise ValueError(f'success must be true or false, not {params["success"]}')
+        filters['success'] = params['success'].lower() in ('true', '1')
+    return filters
+
+
+def date_filter(field, since, until):
+    # Whole days for dates, so an end date includes that day
+    q = Q()
+    for lookup, when in [('gte', since), ('lte', until)]:
+        if isinstance(when, datetime.datetime):
+            q &= Q(**{f'{field}__{lookup}': when})
+        elif when is not None:
+            q &= Q(**{f'{field}__date__{lookup}': when})
+    return q
+
+
+def submissions_with_runs(oses=None, level=None, since=None, until=None, success=None):
+    """
+    Yields (submission, runs) as dicts, ordered by submission id, in constant memory.
+
+    Submissions and runs are read with two chunked queries in the same order and merged,
+    instead of a prefetch per page. Filtering by OS, level or success keeps only the
+    matching runs, and the submissions that have at least one.
+    """
+    run_filter = date_filter('submission__upload_date', since, until)
+    if oses:
+        run_filter &= Q(os__in=oses)
+    if level is not None:
+        run_filter &= Q(score__level_name__iexact=level)
+    if success is not None:
+        run_filter &= Q(score__success=success)
+
+    submissions = Submission.objects.filter(date_filter('upload_date', since, until))
+    if oses or level is not None or success is not None:
+        submissions = submissions.filter(id__in=Run.objects.filter(run_filter).values('submission_id'))
+
+    runs = Run.objects.filter(run_filter) \
+        .order_by('submission_id', 'id') \
+        .values('submission_id', *RUN_COLUMNS, *[f'score__{column}' for column in SCORE_COLUMNS]) \
+        .iterator(chunk_size=CHUNK_SIZE)
+    submissions = submissions.order_by('id').values(*SUBMISSION_COLUMNS).iterator(chunk_size=CHUNK_SIZE)
+
+    run = next(runs, None)
+    for submission in submissions:
+        submission_runs = []
+        while run is not None and run['submission_id'] == submission['id']:
+            submission_runs.append(run)
+            run = next(runs, None)
+        yield submission, submission_runs
+
+
+def buffered(pieces):
+    """Joins small strings into chunks of about BUFFER_SIZE bytes, so each write to the response isn't one row."""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= BUFFER_SIZE:
+            yield ''.join(buffer).encode()
+            buffer = []
+            size = 0
+    if len(buffer) > 0:
+        yield ''.join(buffer).encode()
+
+
+def run_record(run):
+    record = {column: run[column] for column in RUN_COLUMNS}
+    if run['score__success'] is None:
+        record['score'] = None
+    else:
+        record['score'] = {column: run[f'score__{column}'] for column in SCORE_COLUMNS}
+    return record
+
+
+def ndjson_lines(rows):
+    """One JSON object per submission, with its runs nested."""
+    encoder = DjangoJSONEncoder()
+    for submission, runs in rows:
+        yield encoder.encode({**submission, 'runs': [run_record(run) for run in runs]}) + '\n'
+
+
+class Echo:
+    """Just enough of a file for csv.writer to hand back each line it formats."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    """One row per run, with the submission columns repeated; submissions without runs get one row of their own."""
+    writer = csv.writer(Echo())
+    yield writer.writerow([f'submission_{column}' for column in SUBMISSION_COLUMNS] +
+                          [f'run_{column}' for column in RUN_COLUMNS] +
+                          [f'score_{column}' for column in SCORE_COLUMNS])
+    empty_run = [None] * (len(RUN_COLUMNS) + len(SCORE_COLUMNS))
+    for submission, runs in rows:
+        submission_cells = [submission[column] for column in SUBMISSION_COLUMNS]
+        if len(runs) == 0:
+            yield writer.writerow(submission_cells + empty_run)
+        for run in runs:
+            yield writer.writerow(submission_cells +
+                                  [run[column] for column in RUN_COLUMNS] +
+                                  [run[f'score__{column}'] for column in SCORE_COLUMNS])
+
+
+FORMATS = {
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+    'csv': (csv_lines, 'text/csv'),
+}
+
+
+def export(format, **filters):
+    """Encoded chunks of the export in the given format, see submissions_with_runs for the filters."""
+    lines, _ = FORMATS[format]
+    return buffered(lines(submissions_with_runs(**filters)))
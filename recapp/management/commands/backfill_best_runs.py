@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recapp.management.utils import submission_batches
+from recapp.models import Submission
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the denormalized best run of every submission'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        for done, total, batch in submission_batches(Submission.objects.all(), options['batch_size']):
+            with transaction.atomic():
+                for submission in batch:
+                    submission.refresh_best_run(submission.runs.all())
+            self.stdout.write(f'{done} / {total} submissions')
+
+        self.stdout.write(self.style.SUCCESS('Best runs backfilled'))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from recapp.management.utils import submission_batches
+from recapp.models import Submission, Score
+
+
+class Command(BaseCommand):
+    help = 'Stores the expected time range of every submission and the desync flag of every score'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        desyncs = 0
+        for done, total, batch in submission_batches(Submission.objects.all(), options['batch_size']):
+            scores = []
+            for submission in batch:
+                # Existing TAS flags were already guessed when they were added, so leave them alone
+                is_tas = submission.is_tas
+                submission.guess_from_name()
+                submission.is_tas = is_tas
+                submission.updated_date = timezone.now()
+
+                for run in submission.runs.all():
+                    if run.score is not None:
+                        run.score.desync = run.score.desync_for(submission)
+                        desyncs += run.score.desync
+                        scores.append(run.score)
+
+            with transaction.atomic():
+                Submission.objects.bulk_update(batch, ['expected_time', 'expected_time_min', 'expected_time_max',
+                                                        'updated_date'])
+                Score.objects.bulk_update(scores, ['desync'])
+            self.stdout.write(f'{done} / {total} submissions')
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled, {desyncs} desynced scores'))
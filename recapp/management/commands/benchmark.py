@@ -0,0 +1,162 @@
+import json
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from recapp.models import Submission, Run, Score, Job
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = 'Seeds a throwaway database with synthetic data and reports latency and query counts of the main views as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--submissions', type=int, default=2000)
+        parser.add_argument('--os', default='windows,mac,windows-newphys221029',
+                            help='Comma separated OS labels every submission is run on')
+        parser.add_argument('--pending-os', default='wine', help='OS label every submission is queued for')
+        parser.add_argument('--discrepancy-rate', type=float, default=0.05,
+                            help='Fraction of runs whose time differs from the other OSes')
+        parser.add_argument('--failure-rate', type=float, default=0.05, help='Fraction of runs that fail')
+        parser.add_argument('--error-rate', type=float, default=0.01, help='Fraction of runs that error')
+        parser.add_argument('--iterations', type=int, default=20, help='Requests per endpoint')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the report here instead of stdout')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+
+        # A file rather than SQLite's default in-memory test database, so timings include disk access
+        with tempfile.TemporaryDirectory() as directory:
+            settings.DATABASES[connection.alias].setdefault('TEST', {})['NAME'] = str(Path(directory) / 'benchmark.sqlite3')
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                started = time.perf_counter()
+                self.seed(options)
+                seed_time = time.perf_counter() - started
+                results = self.measure(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = json.dumps({
+            'parameters': {key: options[key] for key in [
+                'submissions', 'os', 'pending_os', 'discrepancy_rate', 'failure_rate', 'error_rate', 'iterations', 'seed'
+            ]},
+            'seed_seconds': seed_time,
+            'endpoints': results,
+        }, indent=4)
+        if options['output']:
+            Path(options['output']).write_text(report)
+        else:
+            self.stdout.write(report)
+
+    def seed(self, options):
+        self.stderr.write(f'Seeding {options["submissions"]} submissions...')
+        oses = options['os'].split(',')
+        levels = ['Elevator', 'Learning_To_Roll', 'Marble_Melee_Primer', 'Tube_Treasure', 'Pitfalls']
+
+        self.user = User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+
+        batch_size = 500
+        for start in range(0, options['submissions'], batch_size):
+            runs = []
+            for i in range(start, min(start + batch_size, options['submissions'])):
+                score_time = random.randint(2000, 600000)
+                name = f'{random.choice(levels)}_{score_time // 60000:02}.{score_time // 1000 % 60:02}.{score_time % 1000:03}.rec'
+                submission = Submission(file=f'uploads/{i:064x}.rec', name=name, hash=f'{i:064x}',
+                                        upload_date=timezone.now())
+                submission.guess_from_name()
+                submission.save()
+                Job.enqueue(submission, [options['pending_os']])
+
+                for os in oses:
+                    run = Run(submission=submission, os=os)
+                    roll = random.random()
+                    if roll < options['error_rate']:
+                        run.error = 'Synthetic crash'
+                    elif roll < options['error_rate'] + options['failure_rate']:
+                        run.score = self.make_score(False, 0)
+                    elif roll < options['error_rate'] + options['failure_rate'] + options['discrepancy_rate']:
+                        run.score = self.make_score(True, score_time + random.randint(1, 500))
+                    else:
+                        run.score = self.make_score(True, score_time)
+                    runs.append(run)
+            Run.record(runs)
+            self.stderr.write(f'{min(start + batch_size, options["submissions"])} / {options["submissions"]}')
+
+    @staticmethod
+    def make_score(success, score_time):
+        return Score(success=success, mission='marble/data/missions/beginner/elevator.mis', level_name='Elevator',
+                     score_time=score_time, elapsed_time=score_time, bonus_time=0, gem_count=0, gem_total=0,
+                     fps=random.uniform(30, 1000), frames_count=random.randint(100, 100000),
+                     frames_time=score_time + random.randint(0, 5000))
+
+    def measure(self, options):
+        oses = options['os'].split(',')
+        os1, os2 = oses[0], oses[1 % len(oses)]
+        client = Client()
+        api = Client()
+        api.force_login(self.user)
+        submission_ids = list(Submission.objects.values_list('id', flat=True))
+
+        endpoints = [
+            ('index', client, lambda: '/', True),
+            ('index (cached)', client, lambda: '/', False),
+            ('compare', client, lambda: f'/compare/{os1}/{os2}', False),
+            ('compare (json)', client, lambda: f'/compare/{os1}/{os2}?format=json', False),
+            ('best', client, lambda: '/best', False),
+            ('worst', client, lambda: '/worst', False),
+            ('detail', client, lambda: f'/submissions/{random.choice(submission_ids)}', False),
+            ('pending submissions api', api, lambda: f'/api/pending_submissions/{options["pending_os"]}/', False),
+            ('submissions api', api, lambda: '/api/submissions/', False),
+        ]
+
+        results = {}
+        for name, endpoint_client, url, clear_cache in endpoints:
+            self.stderr.write(f'Measuring {name}...')
+            timings = []
+            queries = []
+            for _ in range(options['iterations']):
+                if clear_cache:
+                    cache.clear()
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    response = endpoint_client.get(url())
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                    timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    self.stderr.write(self.style.WARNING(f'{name} responded {response.status_code}'))
+                queries.append(len(captured))
+
+            results[name] = {
+                'ms': {
+                    'min': min(timings),
+                    'mean': statistics.mean(timings),
+                    'p50': percentile(timings, 0.5),
+                    'p90': percentile(timings, 0.9),
+                    'p99': percentile(timings, 0.99),
+                    'max': max(timings),
+                },
+                'queries': {
+                    'min': min(queries),
+                    'max': max(queries),
+                },
+            }
+        return results
@@ -0,0 +1,132 @@
+import json
+import random
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.utils import timezone
+
+from recapp.models import Submission, Run, Score
+from recapp.retry import retry_on_lock
+from recapp.views import dashboard, best_scores
+
+PROFILES = {
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'OPTIONS': {}},
+    'production': settings.SQLITE_PRODUCTION,
+}
+
+
+def make_score(score_time):
+    return Score(success=True, mission='marble/data/missions/beginner/elevator.mis', level_name='Elevator',
+                 score_time=score_time, elapsed_time=score_time, bonus_time=0, gem_count=0, gem_total=0,
+                 fps=60.0, frames_count=100, frames_time=score_time)
+
+
+def summary(timings, errors, duration):
+    timings = sorted(timings)
+    return {
+        'count': len(timings),
+        'per_second': len(timings) / duration,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'p50_ms': timings[len(timings) // 2] * 1000 if timings else None,
+        'p99_ms': timings[int(len(timings) * 0.99)] * 1000 if timings else None,
+        'mean_ms': statistics.mean(timings) * 1000 if timings else None,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compares SQLite profiles with runners posting results while the dashboard is being read'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', default='default,production', help='Comma separated: ' + ', '.join(PROFILES))
+        parser.add_argument('--submissions', type=int, default=500)
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to run each profile for')
+
+    def handle(self, *args, **options):
+        original = dict(connections.databases['default'])
+        report = {}
+        try:
+            for profile in options['profiles'].split(','):
+                with tempfile.TemporaryDirectory() as directory:
+                    self.use_database({**original, **PROFILES[profile], 'NAME': str(Path(directory) / 'benchmark.sqlite3')})
+                    self.stderr.write(f'Seeding {profile}...')
+                    call_command('migrate', verbosity=0, interactive=False)
+                    self.seed(options['submissions'])
+                    self.stderr.write(f'Running {profile} for {options["duration"]}s...')
+                    report[profile] = self.run(options)
+                    connection.close()
+        finally:
+            self.use_database(original)
+
+        self.stdout.write(json.dumps(report, indent=4))
+
+    @staticmethod
+    def use_database(settings_dict):
+        # Connections are per thread and created on first use, so every thread started
+        # after this (and this one, once its old connection is dropped) gets the new settings
+        connection.close()
+        del connections['default']
+        connections.databases['default'] = settings_dict
+
+    def seed(self, count):
+        runs = []
+        for i in range(count):
+            submission = Submission.objects.create(file=f'uploads/{i:064x}.rec', name=f'Elevator_{i}.rec',
+                                                   hash=f'{i:064x}', upload_date=timezone.now())
+            for os in ['windows', 'mac']:
+                run = Run(submission=submission, os=os)
+                run.score = make_score(3000 + i)
+                runs.append(run)
+        Run.record(runs)
+        self.submission_ids = list(Submission.objects.values_list('id', flat=True))
+
+    def run(self, options):
+        deadline = time.perf_counter() + options['duration']
+        results = {'write': ([], []), 'read': ([], [])}
+        lock = threading.Lock()
+
+        @retry_on_lock
+        def write():
+            run = Run(submission_id=random.choice(self.submission_ids), os=random.choice(['windows', 'mac', 'wine']))
+            run.score = make_score(random.randint(3000, 4000))
+            Run.record([run])
+
+        def read():
+            # What the index page runs on a cache miss
+            dashboard()
+            list(best_scores(10))
+
+        def worker(kind, operation):
+            timings, errors = [], []
+            try:
+                while time.perf_counter() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        operation()
+                    except Exception as e:
+                        errors.append(f'{type(e).__name__}: {e}')
+                    else:
+                        timings.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+            with lock:
+                results[kind][0].extend(timings)
+                results[kind][1].extend(errors)
+
+        threads = [threading.Thread(target=worker, args=('write', write)) for _ in range(options['writers'])] + \
+                  [threading.Thread(target=worker, args=('read', read)) for _ in range(options['readers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return {kind: summary(timings, errors, options['duration']) for kind, (timings, errors) in results.items()}
@@ -0,0 +1,92 @@
+import datetime
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from recapp.export import parse_when
+from recapp.models import Campaign
+
+
+def parse_date(value):
+    when = parse_when(value)
+    if not isinstance(when, datetime.datetime):
+        when = datetime.datetime.combine(when, datetime.time())
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return when
+
+
+class Command(BaseCommand):
+    help = 'Creates re-verification campaigns for a new OS label, and shows, pauses or resumes them'
+
+    def add_arguments(self, parser):
+        actions = parser.add_subparsers(dest='action', required=True)
+
+        create = actions.add_parser('create', help='Start re-verifying past submissions on an OS label')
+        create.add_argument('name')
+        create.add_argument('--os', required=True, help='OS label to run the submissions on')
+        create.add_argument('--baseline', required=True, help='OS label to compare the results against')
+        create.add_argument('--level', help='Only submissions of this level')
+        create.add_argument('--from', dest='uploaded_after', type=parse_date, help='Only submissions uploaded since')
+        create.add_argument('--to', dest='uploaded_before', type=parse_date, help='Only submissions uploaded until')
+        create.add_argument('--rate', type=int, help='Most jobs queued per hour')
+        create.add_argument('--max-pending', type=int, default=100, help='Most jobs queued at once')
+
+        actions.add_parser('list', help='Every campaign with its progress')
+        for name, description in [('pause', 'Stop queueing jobs'), ('resume', 'Start queueing jobs again'),
+                                  ('report', 'Discrepancies against the baseline OS, as JSON')]:
+            actions.add_parser(name, help=description).add_argument('id', type=int)
+
+    def handle(self, *args, **options):
+        getattr(self, options['action'])(options)
+
+    def get_campaign(self, options):
+        try:
+            return Campaign.objects.get(pk=options['id'])
+        except Campaign.DoesNotExist:
+            raise CommandError(f'No campaign {options["id"]}')
+
+    def create(self, options):
+        if options['os'] == options['baseline']:
+            raise CommandError('--os and --baseline must be different labels')
+        if options['os'] in settings.VERIFIER_OS:
+            self.stderr.write(f'{options["os"]} is in VERIFIER_OS, so new uploads are already queued for it')
+        campaign = Campaign.objects.create(name=options['name'], os=options['os'], baseline_os=options['baseline'],
+                                           level=options['level'], uploaded_after=options['uploaded_after'],
+                                           uploaded_before=options['uploaded_before'], rate_limit=options['rate'],
+                                           max_pending=options['max_pending'])
+        self.stdout.write(self.style.SUCCESS(f'Created campaign {campaign.id} for {campaign.total} submissions, '
+                                             f'queued as runners for {campaign.os} claim work'))
+
+    def list(self, options):
+        for campaign in Campaign.objects.order_by('created_date'):
+            progress = campaign.progress()
+            eta = '' if progress['eta'] is None else f', done around {timezone.localtime(progress["eta"]):%Y-%m-%d %H:%M}'
+            self.stdout.write(f'{campaign.id}: {campaign} {campaign.status}, {progress["done"]} / {progress["total"]} run, '
+                              f'{progress["pending"]} queued, {progress["runs_per_minute"]:.1f} runs/min{eta}')
+
+    def pause(self, options):
+        campaign = self.get_campaign(options)
+        if campaign.status != Campaign.Status.ACTIVE:
+            raise CommandError(f'Campaign is {campaign.status}')
+        campaign.pause()
+        self.stdout.write(self.style.SUCCESS(f'Paused {campaign}'))
+
+    def resume(self, options):
+        campaign = self.get_campaign(options)
+        if campaign.status != Campaign.Status.PAUSED:
+            raise CommandError(f'Campaign is {campaign.status}')
+        campaign.resume()
+        self.stdout.write(self.style.SUCCESS(f'Resumed {campaign}'))
+
+    def report(self, options):
+        campaign = self.get_campaign(options)
+        self.stdout.write(json.dumps({
+            'campaign': str(campaign),
+            'status': campaign.status,
+            'progress': campaign.progress(),
+            **campaign.report(),
+        }, indent=4, cls=DjangoJSONEncoder))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from recapp.management.utils import submission_batches
+from recapp.models import Submission, pick_best_run, successful_score_time
+
+
+class Command(BaseCommand):
+    help = 'Checks that the denormalized best run of every submission matches its runs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--fix', action='store_true', help='Recompute the submissions that are out of date')
+
+    def handle(self, *args, **options):
+        stale = []
+        for done, total, batch in submission_batches(Submission.objects.all(), options['batch_size']):
+            for submission in batch:
+                runs = submission.runs.all()
+                best = pick_best_run(runs)
+                best_score_time = successful_score_time(best)
+
+                if submission.best_run_id != (best.id if best is not None else None) \
+                        or submission.best_score_time != best_score_time:
+                    self.stdout.write(f'Submission {submission.id} ({submission.name}): '
+                                      f'stored run {submission.best_run_id} / {submission.best_score_time}, '
+                                      f'expected run {best.id if best is not None else None} / {best_score_time}')
+                    stale.append(submission)
+                    if options['fix']:
+                        with transaction.atomic():
+                            submission.refresh_best_run(runs)
+
+        if len(stale) == 0:
+            self.stdout.write(self.style.SUCCESS('All best runs are consistent'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'Fixed {len(stale)} submissions'))
+        else:
+            raise CommandError(f'{len(stale)} submissions have a stale best run, rerun with --fix to repair them')
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from recapp.models import Submission, Job
+
+
+class Command(BaseCommand):
+    help = 'Queues every submission that has no run yet on the given OS labels, behind fresh uploads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('os', nargs='*', help='OS labels to queue for, defaults to VERIFIER_OS')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        for os in options['os'] or settings.VERIFIER_OS:
+            entries = list(Submission.objects.exclude(runs__os=os).exclude(jobs__os=os)
+                           .order_by('upload_date').values_list('id', 'uploader_id'))
+            for start in range(0, len(entries), batch_size):
+                Job.objects.bulk_create(Job.plan(os, entries[start:start + batch_size], Job.Priority.BACKFILL),
+                                        ignore_conflicts=True)
+            self.stdout.write(self.style.SUCCESS(f'Queued {len(entries)} submissions for {os}'))
@@ -0,0 +1,32 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recapp import export
+
+
+class Command(BaseCommand):
+    help = 'Writes every submission with its runs and scores as NDJSON or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=list(export.FORMATS), default='ndjson')
+        parser.add_argument('--output', help='File to write, instead of stdout')
+        parser.add_argument('--os', help='Only runs on these OS labels, comma separated')
+        parser.add_argument('--level', help='Only runs of this level name')
+        parser.add_argument('--from', help='Only submissions uploaded on or after this date')
+        parser.add_argument('--to', help='Only submissions uploaded on or before this date')
+        parser.add_argument('--success', help='Only successful (true) or failed (false) runs')
+
+    def handle(self, *args, **options):
+        try:
+            filters = export.parse_filters(options)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in export.export(options['format'], **filters):
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
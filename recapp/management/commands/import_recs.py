@@ -0,0 +1,157 @@
+import datetime
+import functools
+import hashlib
+import itertools
+import os
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from recapp import caching
+from recapp.models import Submission, Job
+
+
+def find_recs(path):
+    """Yields (name, location) for every .rec under a directory or in a zip file, without listing them all first."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith('.rec'):
+                    yield os.path.basename(info.filename), (path, info.filename)
+    else:
+        for directory, _, files in os.walk(path):
+            for name in files:
+                if name.lower().endswith('.rec'):
+                    yield name, (os.path.join(directory, name), None)
+
+
+@functools.lru_cache(maxsize=1)
+def open_archive(path):
+    # Kept open for the life of the worker, so the directory isn't read again for every member
+    return zipfile.ZipFile(path)
+
+
+def store_rec(location, uploads_path):
+    """
+    Copies a rec into a temporary file in uploads_path, hashing as it goes.
+    Returns (temporary path, hash, when the rec was last modified as a timestamp).
+    """
+    path, member = location
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=uploads_path, prefix='.import-', suffix='.rec', delete=False) as f:
+        def copy(source):
+            for chunk in iter(lambda: source.read(65536), b''):
+                digest.update(chunk)
+                f.write(chunk)
+
+        try:
+            if member is None:
+                with open(path, 'rb') as source:
+                    copy(source)
+                    modified = os.fstat(source.fileno()).st_mtime
+            else:
+                with open_archive(path).open(member) as source:
+                    copy(source)
+                # Zip files store local time
+                modified = time.mktime(open_archive(path).getinfo(member).date_time + (0, 0, -1))
+        except:
+            os.unlink(f.name)
+            raise
+    return f.name, digest.hexdigest(), modified
+
+
+class Command(BaseCommand):
+    help = 'Imports every .rec in a directory or zip file as a submission, skipping ones already uploaded'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Directory or zip file')
+        parser.add_argument('--batch-size', type=int, default=500, help='Files per database transaction')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Hashing processes')
+        parser.add_argument('--tas', action='store_true', help='Mark every imported rec as a TAS')
+        parser.add_argument('--os', nargs='*', help='OS labels to queue the new submissions for, defaults to VERIFIER_OS')
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['path']):
+            raise CommandError(f'{options["path"]} does not exist')
+
+        os.makedirs(settings.UPLOADS_PATH, exist_ok=True)
+        self.oses = settings.VERIFIER_OS if options['os'] is None else options['os']
+        self.is_tas = options['tas']
+        self.seen = self.created = self.duplicates = self.failed = 0
+        self.started = time.perf_counter()
+
+        recs = find_recs(options['path'])
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            def submit(batch):
+                return [(name, executor.submit(store_rec, location, settings.UPLOADS_PATH)) for name, location in batch]
+
+            # Workers hash the next batch while this one is written to the database
+            pending = submit(itertools.islice(recs, options['batch_size']))
+            while len(pending) > 0:
+                following = submit(itertools.islice(recs, options['batch_size']))
+                self.add_batch(pending)
+                pending = following
+
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {self.created} new submissions from {self.seen} files in {elapsed:.1f}s '
+            f'({self.duplicates} duplicates, {self.failed} failed)'
+        ))
+
+    def add_batch(self, pending):
+        stored = {}
+        for name, future in pending:
+            self.seen += 1
+            try:
+                temp_path, hash, modified = future.result()
+            except Exception as e:
+                self.failed += 1
+                self.stderr.write(f'Could not read {name}: {e}')
+                continue
+            # Imports are old records, dated when they were made rather than now, so they
+            # don't push recent uploads down the newest first lists
+            upload_date = datetime.datetime.fromtimestamp(modified, tz=datetime.timezone.utc)
+            if hash in stored:
+                os.unlink(temp_path)
+                self.duplicates += 1
+                first_name, first_path, first_date = stored[hash]
+                stored[hash] = (first_name, first_path, min(first_date, upload_date))
+            else:
+                stored[hash] = (name, temp_path, upload_date)
+
+        existing = set(Submission.objects.filter(hash__in=stored.keys()).values_list('hash', flat=True))
+        submissions = []
+        for hash, (name, temp_path, upload_date) in stored.items():
+            if hash in existing:
+                os.unlink(temp_path)
+                self.duplicates += 1
+                continue
+            path = f'{settings.UPLOADS_PATH}/{hash}.rec'
+            # Temporary files are created private, uploads are served to everyone
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+            submission = Submission(file=path, name=name, hash=hash, upload_date=upload_date, is_tas=self.is_tas)
+            submission.guess_from_name()
+            submissions.append(submission)
+
+        with transaction.atomic():
+            Submission.objects.bulk_create(submissions)
+            # bulk_create doesn't fill in primary keys on SQLite
+            entries = list(Submission.objects.filter(hash__in=[submission.hash for submission in submissions])
+                           .values_list('id', 'uploader_id'))
+            # Imports are old records, queued behind fresh uploads
+            Job.objects.bulk_create([
+                job for os in self.oses for job in Job.plan(os, entries, Job.Priority.BACKFILL)
+            ], ignore_conflicts=True)
+        # bulk_create sends no post_save signals
+        caching.invalidate()
+
+        self.created += len(submissions)
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(f'{self.seen} files, {self.created} new, {self.duplicates} duplicates, '
+                          f'{self.failed} failed, {self.seen / elapsed:.0f} files/s')
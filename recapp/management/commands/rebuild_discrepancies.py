@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from recapp import caching
+from recapp.management.utils import submission_batches
+from recapp.models import Submission, Discrepancy
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the OS pair discrepancy table from every submission\'s runs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        Discrepancy.objects.all().delete()
+
+        submissions = Submission.objects.filter(runs__isnull=False).distinct()
+        for done, total, batch in submission_batches(submissions, options['batch_size']):
+            for submission in batch:
+                Discrepancy.refresh(submission, submission.runs.all())
+            self.stdout.write(f'{done} / {total} submissions')
+        caching.invalidate()
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {Discrepancy.objects.count()} discrepancies'))
@@ -0,0 +1,12 @@
+from django.db.models import Prefetch
+
+from recapp.models import Run
+
+
+def submission_batches(queryset, batch_size):
+    """Yields lists of submissions from queryset with their runs and scores prefetched."""
+    ids = list(queryset.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(ids), batch_size):
+        batch = queryset.model.objects.filter(id__in=ids[start:start + batch_size]).order_by('id') \
+            .prefetch_related(Prefetch('runs', queryset=Run.objects.select_related('score')))
+        yield min(start + batch_size, len(ids)), len(ids), list(batch)
@@ -0,0 +1,154 @@
+import bisect
+import heapq
+import logging
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+slow_logger = logging.getLogger('recapp.slow_requests')
+
+
+class Histogram:
+    """Cumulative bucket counts, a sum and a total, in the shape Prometheus expects."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': {('+Inf' if bound == float('inf') else bound): total for bound, total in self.cumulative()},
+        }
+
+
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+QUERY_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+HISTOGRAMS = {
+    'request_seconds': ('Wall time spent handling the request', SECONDS_BUCKETS),
+    'db_seconds': ('Time spent in database queries', SECONDS_BUCKETS),
+    'queries': ('Database queries run', QUERY_BUCKETS),
+}
+
+_lock = threading.Lock()
+_views = {}
+
+
+def observe(view, **values):
+    with _lock:
+        histograms = _views.setdefault(view, {
+            name: Histogram(buckets) for name, (_, buckets) in HISTOGRAMS.items()
+        })
+        for name, value in values.items():
+            histograms[name].observe(value)
+
+
+def snapshot():
+    """Per view name, the histograms recorded by MetricsMiddleware in this process."""
+    with _lock:
+        return {
+            view: {name: histogram.as_dict() for name, histogram in histograms.items()}
+            for view, histograms in _views.items()
+        }
+
+
+def reset():
+    with _lock:
+        _views.clear()
+
+
+def prometheus_text(views):
+    """Histograms in the shape returned by snapshot(), in the Prometheus text exposition format."""
+    lines = []
+    for name, (description, _) in HISTOGRAMS.items():
+        metric = f'recapp_{name}'
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} histogram')
+        for view, histograms in sorted(views.items()):
+            histogram = histograms[name]
+            label = view.replace('\\', '\\\\').replace('"', '\\"')
+            for bound, total in histogram['buckets'].items():
+                lines.append(f'{metric}_bucket{{view="{label}",le="{bound}"}} {total}')
+            lines.append(f'{metric}_sum{{view="{label}"}} {histogram["sum"]}')
+            lines.append(f'{metric}_count{{view="{label}"}} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class QueryRecorder:
+    """Database execute wrapper that totals query time and keeps the slowest queries."""
+
+    def __init__(self, keep):
+        self.keep = keep
+        self.count = 0
+        self.duration = 0
+        self.slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.count += 1
+            self.duration += duration
+            # The counter breaks ties so that SQL strings are never compared
+            entry = (duration, self.count, sql)
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+    def top(self):
+        return [(duration, sql) for duration, _, sql in sorted(self.slowest, reverse=True)]
+
+
+class MetricsMiddleware:
+    """
+    Records wall time, database time and query count of every request, per resolved view name.
+
+    Requests slower than SLOW_REQUEST_THRESHOLD seconds are logged to recapp.slow_requests
+    along with their slowest queries.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder(settings.SLOW_REQUEST_QUERIES)
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else '<unresolved>'
+        observe(view, request_seconds=elapsed, db_seconds=recorder.duration, queries=recorder.count)
+
+        threshold = settings.SLOW_REQUEST_THRESHOLD
+        if threshold is not None and elapsed >= threshold:
+            slow_logger.warning(
+                'Slow request: %s %s (%s) took %.3fs, %.3fs in %d queries\n%s',
+                request.method, request.get_full_path(), view, elapsed, recorder.duration, recorder.count,
+                '\n'.join(f'  {duration:.3f}s {sql}' for duration, sql in recorder.top())
+            )
+        return response
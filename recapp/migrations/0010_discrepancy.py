@@ -0,0 +1,54 @@
+# Generated by Django 3.2.7 on 2026-10-18 09:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recapp', '0009_submission_expected_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Plugin',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(max_length=255, upload_to='uploads', verbose_name='File')),
+                ('name', models.TextField(verbose_name='Plugin Name')),
+                ('update_date', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='submission',
+            name='expected_time',
+            field=models.IntegerField(default=None, null=True, verbose_name='Expected Time'),
+        ),
+        migrations.AlterField(
+            model_name='submission',
+            name='is_tas',
+            field=models.BooleanField(default=False, verbose_name='Is TAS'),
+        ),
+        migrations.CreateModel(
+            name='Discrepancy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('os_a', models.TextField(max_length=32, verbose_name='OS A')),
+                ('os_b', models.TextField(max_length=32, verbose_name='OS B')),
+                ('kind', models.CharField(choices=[('any', 'Any'), ('score', 'Score')], max_length=8, verbose_name='Kind')),
+                ('upload_date', models.DateTimeField(verbose_name='Upload date')),
+                ('run_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='recapp.run')),
+                ('run_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='recapp.run')),
+                ('submission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='discrepancies', to='recapp.submission')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='discrepancy',
+            index=models.Index(fields=['os_a', 'os_b', 'kind', 'upload_date'], name='discrepancy_pair_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='discrepancy',
+            constraint=models.UniqueConstraint(fields=('submission', 'os_a', 'os_b', 'kind'), name='unique_discrepancy'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.7 on 2026-10-18 09:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recapp', '0010_discrepancy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='best_run',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='recapp.run'),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='best_score_time',
+            field=models.IntegerField(db_index=True, default=None, null=True, verbose_name='Best Score Time'),
+        ),
+    ]
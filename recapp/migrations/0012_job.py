@@ -0,0 +1,37 @@
+# Generated by Django 3.2.7 on 2026-10-18 09:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recapp', '0011_submission_best_run'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('os', models.TextField(max_length=32, verbose_name='OS')),
+                ('enqueue_date', models.DateTimeField(verbose_name='Enqueue Date')),
+                ('available_date', models.DateTimeField(verbose_name='Available Date')),
+                ('lease_token', models.CharField(default=None, max_length=32, null=True, verbose_name='Lease Token')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Attempts')),
+                ('lease_owner', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('submission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='recapp.submission')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['os', 'available_date'], name='job_os_available'),
+        ),
+        migrations.AddConstraint(
+            model_name='job',
+            constraint=models.UniqueConstraint(fields=('submission', 'os'), name='unique_job'),
+        ),
+    ]
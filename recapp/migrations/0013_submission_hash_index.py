@@ -0,0 +1,18 @@
+# Generated by Django 3.2.7 on 2026-10-18 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recapp', '0012_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='submission',
+            name='hash',
+            field=models.TextField(db_index=True, max_length=128, verbose_name='File Hash'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.7 on 2026-10-18 09:11
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recapp', '0013_submission_hash_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='duration',
+            field=models.FloatField(default=None, null=True, verbose_name='Run Duration'),
+        ),
+        migrations.CreateModel(
+            name='RunnerHeartbeat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('os', models.TextField(max_length=32, verbose_name='OS')),
+                ('last_poll', models.DateTimeField(default=None, null=True, verbose_name='Last Poll')),
+                ('last_result', models.DateTimeField(default=None, null=True, verbose_name='Last Result')),
+                ('run_rate', models.FloatField(default=0, verbose_name='Runs per Minute')),
+                ('mean_duration', models.FloatField(default=None, null=True, verbose_name='Mean Run Duration')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='runnerheartbeat',
+            constraint=models.UniqueConstraint(fields=('user', 'os'), name='unique_runner_heartbeat'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.7 on 2026-10-18 09:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recapp', '0014_runnerheartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='score',
+            name='desync',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='Desync'),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='expected_time_max',
+            field=models.IntegerField(db_index=True, default=None, null=True, verbose_name='Expected Time Max'),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='expected_time_min',
+            field=models.IntegerField(db_index=True, default=None, null=True, verbose_name='Expected Time Min'),
+        ),
+    ]
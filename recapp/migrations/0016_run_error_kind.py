@@ -0,0 +1,18 @@
+# Generated by Django 3.2.7 on 2026-10-18 09:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recapp', '0015_desync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='error_kind',
+            field=models.CharField(blank=True, choices=[('crash', 'Crash'), ('timeout', 'Timeout')], default=None, max_length=16, null=True, verbose_name='Error Kind'),
+        ),
+    ]
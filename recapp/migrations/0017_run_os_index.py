@@ -0,0 +1,18 @@
+# Generated by Django 3.2.7 on 2026-10-18 09:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recapp', '0016_run_error_kind'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='run',
+            name='os',
+            field=models.TextField(db_index=True, max_length=32, verbose_name='OS'),
+        ),
+    ]
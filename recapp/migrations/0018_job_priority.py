@@ -0,0 +1,58 @@
+# Generated by Django 3.2.7 on 2026-10-18 09:40
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def sort_by_enqueue_date(apps, schema_editor):
+    # Jobs queued before priorities existed keep their first in, first out order
+    Job = apps.get_model('recapp', 'Job')
+    Job.objects.update(sort_key=F('enqueue_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recapp', '0017_run_os_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='uploader',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='priority',
+            field=models.CharField(choices=[('fresh', 'Fresh Upload'), ('reverify', 'Re-verification'), ('backfill', 'Backfill')], default='fresh', max_length=16, verbose_name='Priority'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='uploader',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='sort_key',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Sort Key'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(sort_by_enqueue_date, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='job',
+            name='job_os_available',
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['os', 'sort_key'], name='job_os_sort_key'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['os', 'priority', 'uploader', 'sort_key'], name='job_uploader_tail'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.7 on 2026-10-18 09:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recapp', '0018_job_priority'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Campaign',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField(verbose_name='Name')),
+                ('os', models.TextField(max_length=32, verbose_name='OS')),
+                ('baseline_os', models.TextField(max_length=32, verbose_name='Baseline OS')),
+                ('level', models.TextField(blank=True, default=None, null=True, verbose_name='Level')),
+                ('uploaded_after', models.DateTimeField(blank=True, default=None, null=True, verbose_name='Uploaded After')),
+                ('uploaded_before', models.DateTimeField(blank=True, default=None, null=True, verbose_name='Uploaded Before')),
+                ('rate_limit', models.IntegerField(blank=True, default=None, null=True, verbose_name='Jobs per Hour')),
+                ('max_pending', models.IntegerField(default=100, verbose_name='Max Pending Jobs')),
+                ('status', models.CharField(choices=[('active', 'Active'), ('paused', 'Paused'), ('complete', 'Complete')], default='active', max_length=16, verbose_name='Status')),
+                ('created_date', models.DateTimeField(verbose_name='Created Date')),
+                ('completed_date', models.DateTimeField(default=None, null=True, verbose_name='Completed Date')),
+                ('position', models.BigIntegerField(default=0, verbose_name='Position')),
+                ('total', models.IntegerField(default=0, verbose_name='Total')),
+                ('queued', models.IntegerField(default=0, verbose_name='Queued')),
+                ('allowance', models.FloatField(default=0, verbose_name='Allowance')),
+                ('last_top_up', models.DateTimeField(default=None, null=True, verbose_name='Last Top Up')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='campaign',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='recapp.campaign'),
+        ),
+    ]
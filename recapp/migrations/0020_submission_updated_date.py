@@ -0,0 +1,20 @@
+# Generated by Django 3.2.7 on 2026-10-18 14:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recapp', '0019_campaign'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='updated_date',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='Updated Date'),
+            preserve_default=False,
+        ),
+    ]
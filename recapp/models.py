@@ -1,14 +1,21 @@
 from typing import Optional, Tuple
 
+import datetime
 import hashlib
+import itertools
+import math
+import os
 import re
+import secrets
+import tempfile
 from django.core.files.uploadedfile import UploadedFile
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from enum import Enum
 from pathlib import Path
 
-from django.db import models
+from django.db import models, transaction, connection
+from django.db.models import F, Max
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 
@@ -16,6 +23,8 @@ from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 from rest_framework.exceptions import ValidationError
 
+from recapp import caching
+
 
 def guess_tas(sub: 'Submission'):
     if re.search(r'(\b|_)tas(\b|_)', sub.name, re.IGNORECASE) is not None:
@@ -71,13 +80,51 @@ def guess_time_range(sub: 'Submission') -> Optional[Tuple[int, int]]:
     return None
 
 
+def pick_best_run(runs):
+    best = None
+    for run in runs:
+        if best is None:
+            best = run
+            continue
+        if best.error is not None and run.error is None:
+            best = run
+            continue
+        if best.error is not None or run.error is not None:
+            continue
+        if not best.score.success and run.score.success:
+            best = run
+            continue
+        if not best.score.success or not run.score.success:
+            continue
+        if best.score.score_time > run.score.score_time:
+            best = run
+            continue
+    return best
+
+
+def successful_score_time(run) -> Optional[int]:
+    if run is None or run.error is not None or not run.score.success:
+        return None
+    return run.score.score_time
+
+
 class Submission(models.Model):
     file = models.FileField('File', upload_to=str(settings.UPLOADS_PATH), max_length=255)
     name = models.TextField('File Name')
-    hash = models.TextField('File Hash', max_length=128)
+    hash = models.TextField('File Hash', max_length=128, db_index=True)
     upload_date = models.DateTimeField('Upload date')
     is_tas = models.BooleanField('Is TAS', default=False)
     expected_time = models.IntegerField('Expected Time', default=None, null=True)
+    # Range of score times the file name allows for, see guess_from_name
+    expected_time_min = models.IntegerField('Expected Time Min', default=None, null=True, db_index=True)
+    expected_time_max = models.IntegerField('Expected Time Max', default=None, null=True, db_index=True)
+    # Denormalized from the runs, see refresh_best_run
+    best_run = models.ForeignKey('Run', related_name='+', on_delete=models.SET_NULL, default=None, null=True)
+    best_score_time = models.IntegerField('Best Score Time', default=None, null=True, db_index=True)
+    # Who uploaded it, if they were signed in; their jobs share one lane of the queue, see Job.plan
+    uploader = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.SET_NULL, default=None, null=True)
+    # Any change to the row, for the list validators; update() skips auto_now, so those callers set it themselves
+    updated_date = models.DateTimeField('Updated Date', auto_now=True)
 
     def __str__(self):
         return f"{self.name}"
@@ -91,27 +138,36 @@ class Submission(models.Model):
 
         super().save(*args, **kwargs)
 
-    @property
-    def best_run(self):
-        best = None
-        for run in self.runs.all():
-            if best is None:
-                best = run
-                continue
-            if best.error is not None and run.error is None:
-                best = run
-                continue
-            if best.error is not None or run.error is not None:
-                continue
-            if not best.score.success and run.score.success:
-                best = run
-                continue
-            if not best.score.success or not run.score.success:
-                continue
-            if best.score.score_time > run.score.score_time:
-                best = run
-                continue
-        return best
+    def guess_from_name(self):
+        """Fills in what can be guessed from the file name, once, so reads never run the regexes."""
+        if self.expected_time is None:
+            self.expected_time = guess_time(self)
+        guess = guess_time_range(self)
+        if guess is None:
+            self.expected_time_min, self.expected_time_max = None, None
+        else:
+            self.expected_time_min, self.expected_time_max = guess
+        if not self.is_tas:
+            self.is_tas = guess_tas(self)
+
+    def refresh_desync(self):
+        """Recomputes the desync flag of this submission's scores, after its expected time changed."""
+        scores = [run.score for run in self.runs.select_related('score') if run.score is not None]
+        for score in scores:
+            score.desync = score.desync_for(self)
+        Score.objects.bulk_update(scores, ['desync'])
+
+    def refresh_best_run(self, runs=None):
+        """Recomputes the denormalized best run columns from this submission's runs."""
+        if runs is None:
+            runs = self.runs.select_related('score')
+
+        self.best_run = pick_best_run(runs)
+        self.best_score_time = successful_score_time(self.best_run)
+
+        self.updated_date = timezone.now()
+        Submission.objects.filter(pk=self.pk).update(best_run=self.best_run, best_score_time=self.best_score_time,
+                                                     updated_date=self.updated_date)
 
     @staticmethod
     def create_or_find(form_data):
@@ -119,8 +175,20 @@ class Submission(models.Model):
             raise ValidationError("Need file")
 
         rec: UploadedFile = form_data['file']
-        conts = rec.read()
-        hash = hashlib.sha256(conts).hexdigest()
+
+        # Hash while copying chunk by chunk, so the upload is never fully in memory
+        os.makedirs(settings.UPLOADS_PATH, exist_ok=True)
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=settings.UPLOADS_PATH, prefix='.upload-', suffix='.rec', delete=False) as f:
+            temp_path = f.name
+            try:
+                for chunk in rec.chunks():
+                    digest.update(chunk)
+                    f.write(chunk)
+            except:
+                os.unlink(temp_path)
+                raise
+        hash = digest.hexdigest()
 
         name = rec.name
         if len(name) == 0:
@@ -129,15 +197,18 @@ class Submission(models.Model):
         # See if one exists already
         try:
             sub = Submission.objects.get(hash=hash)
+            os.unlink(temp_path)
         except Submission.DoesNotExist:
             path = f'{settings.UPLOADS_PATH}/{hash}.rec'
-            with open(path, 'wb') as f:
-                f.write(conts)
+            # Temporary files are created private, uploads are served to everyone
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
             form_data['file'] = path
             form_data['name'] = name
             form_data['hash'] = hash
             form_data['upload_date'] = timezone.now()
             sub = Submission(**form_data)
+            # Guessing from the name and queueing happen in derive_submission
             sub.save()
 
         return sub
@@ -155,35 +226,589 @@ class Score(models.Model):
     fps = models.FloatField('Approximate FPS')
     frames_count = models.IntegerField('Frame Count')
     frames_time = models.IntegerField('Frame Time')
+    # Set when the run is recorded, see desync_for
+    desync = models.BooleanField('Desync', default=False, db_index=True)
 
     def __str__(self):
         return f"success: {self.success} time: {self.score_time}"
 
-    @property
-    def is_desync(self) -> bool:
+    def desync_for(self, submission: 'Submission') -> bool:
         if not self.success:
             return False
-        if self.run.submission.expected_time is None:
+        if submission.expected_time is None:
             return False
-        if self.score_time == self.run.submission.expected_time:
+        if self.score_time == submission.expected_time:
             return False
-        guess = guess_time_range(self.run.submission)
-        if guess is None:
+        if submission.expected_time_min is None:
             return False
-        if self.score_time < guess[0]:
+        if self.score_time < submission.expected_time_min:
             return True
-        if self.score_time > guess[1]:
+        if self.score_time > submission.expected_time_max:
             return True
         return False
 
 
 class Run(models.Model):
     submission = models.ForeignKey(Submission, related_name='runs', on_delete=models.CASCADE)
-    os = models.TextField('OS', max_length=32)
+    os = models.TextField('OS', max_length=32, db_index=True)
     run_date = models.DateTimeField('Run Date')
     score = models.OneToOneField(Score, related_name='run', on_delete=models.CASCADE, null=True)
     error = models.TextField('Error Message', null=True)
 
+    class ErrorKind(models.TextChoices):
+        # recverify exited with an error or without reporting a status
+        CRASH = 'crash', _('Crash')
+        # The runner killed recverify after it ran past its time limit
+        TIMEOUT = 'timeout', _('Timeout')
+
+    error_kind = models.CharField('Error Kind', max_length=16, choices=ErrorKind.choices, default=None, null=True, blank=True)
+    # As measured by the runner, in seconds
+    duration = models.FloatField('Run Duration', default=None, null=True)
+
+    @staticmethod
+    def record(runs):
+        """
+        Saves new runs (and their unsaved scores) in one transaction and takes them off the
+        queue. Best runs and discrepancies are updated by tasks, see run_saved.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            scores = []
+            for run in runs:
+                if run.score is not None:
+                    run.score.desync = run.score.desync_for(run.submission)
+                    scores.append(run.score)
+            if connection.features.can_return_rows_from_bulk_insert:
+                Score.objects.bulk_create(scores)
+            else:
+                for score in scores:
+                    score.save()
+
+            for run in runs:
+                run.run_date = now
+                # Picks up the primary key of the score saved above
+                run.score = run.score
+            if connection.features.can_return_rows_from_bulk_insert:
+                Run.objects.bulk_create(runs)
+                # bulk_create sends no signals, and post_save is what queues the derived updates
+                for run in runs:
+                    post_save.send(sender=Run, instance=run, created=True, update_fields=None, raw=False,
+                                   using=connection.alias)
+            else:
+                for run in runs:
+                    run.save()
+
+            by_os = {}
+            for run in runs:
+                by_os.setdefault(run.os, []).append(run.submission_id)
+            for os, submission_ids in by_os.items():
+                Job.objects.filter(submission_id__in=submission_ids, os=os).delete()
+
+        # bulk_create and update() skip the signals that normally do this
+        caching.invalidate()
+
+
+def compare_runs(run_a: 'Run', run_b: 'Run'):
+    """Returns the Discrepancy kinds that apply between two runs of the same submission."""
+    if run_a.error is not None or run_b.error is not None:
+        if (run_a.error is None) != (run_b.error is None):
+            return [Discrepancy.Kind.ANY]
+        return []
+
+    score_a = run_a.score
+    score_b = run_b.score
+    if score_a.success != score_b.success:
+        return [Discrepancy.Kind.ANY]
+    if score_a.score_time == score_b.score_time \
+            and score_a.elapsed_time == score_b.elapsed_time \
+            and score_a.bonus_time == score_b.bonus_time:
+        return []
+    if score_a.success:
+        return [Discrepancy.Kind.ANY, Discrepancy.Kind.SCORE]
+    return [Discrepancy.Kind.ANY]
+
+
+class Discrepancy(models.Model):
+    """
+    A mismatch between the latest runs of one submission on two verifier OSes.
+    Pairs are stored once with os_a < os_b, and are kept up to date whenever a run
+    is recorded (see Discrepancy.refresh), so comparisons are plain indexed lookups.
+    """
+
+    class Kind(models.TextChoices):
+        # Any difference between the two runs, including one of them erroring
+        ANY = 'any', _('Any')
+        # Both runs succeeded but with different times
+        SCORE = 'score', _('Score')
+
+    submission = models.ForeignKey(Submission, related_name='discrepancies', on_delete=models.CASCADE)
+    os_a = models.TextField('OS A', max_length=32)
+    os_b = models.TextField('OS B', max_length=32)
+    kind = models.CharField('Kind', max_length=8, choices=Kind.choices)
+    run_a = models.ForeignKey(Run, related_name='+', on_delete=models.CASCADE)
+    run_b = models.ForeignKey(Run, related_name='+', on_delete=models.CASCADE)
+    # Copied from the submission so lists can be ordered from the index alone
+    upload_date = models.DateTimeField('Upload date')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['submission', 'os_a', 'os_b', 'kind'], name='unique_discrepancy'),
+        ]
+        indexes = [
+            models.Index(fields=['os_a', 'os_b', 'kind', 'upload_date'], name='discrepancy_pair_date'),
+        ]
+
+    def __str__(self):
+        return f"{self.submission}: {self.os_a} vs {self.os_b} ({self.kind})"
+
+    @staticmethod
+    def between(os_one, os_two, kind):
+        os_a, os_b = sorted([os_one, os_two])
+        return Discrepancy.objects.filter(os_a=os_a, os_b=os_b, kind=kind)
+
+    def oriented(self, os_one):
+        """Returns (run on os_one, run on the other OS), sharing the submission."""
+        self.run_b.submission = self.run_a.submission
+        if self.os_a == os_one:
+            return self.run_a, self.run_b
+        return self.run_b, self.run_a
+
+    @staticmethod
+    def refresh(submission, runs=None):
+        """Recomputes every OS pair of a submission from its latest run per OS."""
+        if runs is None:
+            runs = submission.runs.select_related('score')
+
+        latest = {}
+        for run in sorted(runs, key=lambda r: (r.run_date, r.id)):
+            latest[run.os] = run
+
+        rows = []
+        for os_a, os_b in itertools.combinations(sorted(latest), 2):
+            for kind in compare_runs(latest[os_a], latest[os_b]):
+                rows.append(Discrepancy(
+                    submission=submission,
+                    os_a=os_a,
+                    os_b=os_b,
+                    kind=kind,
+                    run_a=latest[os_a],
+                    run_b=latest[os_b],
+                    upload_date=submission.upload_date,
+                ))
+
+        with transaction.atomic():
+            Discrepancy.objects.filter(submission=submission).delete()
+            Discrepancy.objects.bulk_create(rows)
+
+
+class Job(models.Model):
+    """
+    A submission waiting to be verified on one OS. Runners claim jobs under a lease;
+    a job whose lease expires becomes available again, and it is removed once a run
+    for its submission and OS is recorded. Jobs are claimed in sort_key order, see plan.
+    """
+
+    class Priority(models.TextChoices):
+        # Highest first
+        FRESH = 'fresh', 'Fresh Upload'
+        REVERIFY = 'reverify', 'Re-verification'
+        BACKFILL = 'backfill', 'Backfill'
+
+    submission = models.ForeignKey(Submission, related_name='jobs', on_delete=models.CASCADE)
+    os = models.TextField('OS', max_length=32)
+    enqueue_date = models.DateTimeField('Enqueue Date')
+    # When the job can next be claimed: the enqueue date, or the end of the current lease
+    available_date = models.DateTimeField('Available Date')
+    lease_owner = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.SET_NULL, default=None, null=True)
+    lease_token = models.CharField('Lease Token', max_length=32, default=None, null=True)
+    attempts = models.IntegerField('Attempts', default=0)
+    # The campaign that queued it, if any
+    campaign = models.ForeignKey('Campaign', related_name='jobs', on_delete=models.SET_NULL, default=None, null=True)
+    priority = models.CharField('Priority', max_length=16, choices=Priority.choices, default=Priority.FRESH)
+    # Copied from the submission, so an uploader's last job can be found from an index
+    uploader = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.SET_NULL, default=None, null=True)
+    # When the job is due, by priority and fair share between uploaders
+    sort_key = models.DateTimeField('Sort Key')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['submission', 'os'], name='unique_job'),
+        ]
+        indexes = [
+            # Claims walk this in order and skip leased jobs, rather than sorting everything available
+            models.Index(fields=['os', 'sort_key'], name='job_os_sort_key'),
+            models.Index(fields=['os', 'priority', 'uploader', 'sort_key'], name='job_uploader_tail'),
+        ]
+
+    def __str__(self):
+        return f"{self.submission} on {self.os}"
+
+    @staticmethod
+    def share_interval(os, now):
+        """How long the live runners for os take per run between them, the spacing between one uploader's jobs."""
+        rate = RunnerHeartbeat.throughput(os, now)
+        if rate <= 0:
+            return settings.JOB_SHARE_INTERVAL
+        return datetime.timedelta(minutes=1 / rate)
+
+    @staticmethod
+    def plan(os, entries, priority=Priority.FRESH):
+        """
+        Unsaved jobs on os for (submission id, uploader id) pairs, with their sort keys.
+
+        A job is due after its priority's JOB_PRIORITY_DELAY, and no sooner than one
+        share_interval after the uploader's last job at that priority. A large batch from one
+        uploader is spread out at the rate runners get through it, so someone else's upload
+        is due now and lands near the front. The delays are fixed, so lower priority work
+        ages into the front of the queue instead of waiting behind every newer upload.
+        """
+        now = timezone.now()
+        start = now + settings.JOB_PRIORITY_DELAY[priority]
+        interval = Job.share_interval(os, now)
+
+        uploaders = {uploader_id for _, uploader_id in entries}
+        lanes = models.Q(uploader_id__in=[uploader_id for uploader_id in uploaders if uploader_id is not None])
+        if None in uploaders:
+            lanes |= models.Q(uploader_id__isnull=True)
+        tails = dict(Job.objects.filter(lanes, os=os, priority=priority).order_by()
+                     .values_list('uploader_id').annotate(tail=Max('sort_key')))
+
+        jobs = []
+        for submission_id, uploader_id in entries:
+            tail = tails.get(uploader_id)
+            sort_key = start if tail is None else max(start, tail + interval)
+            tails[uploader_id] = sort_key
+            jobs.append(Job(submission_id=submission_id, os=os, priority=priority, uploader_id=uploader_id,
+                            enqueue_date=now, available_date=now, sort_key=sort_key))
+        return jobs
+
+    @staticmethod
+    def enqueue(submission, oses=None, priority=Priority.FRESH):
+        """
+        Queues submission on each OS, moving any unclaimed job queued at a lower priority up to this one,
+        and giving parked jobs a fresh set of attempts.
+        """
+        if oses is None:
+            oses = settings.VERIFIER_OS
+        lower = list(Job.Priority)[list(Job.Priority).index(priority) + 1:]
+        with transaction.atomic():
+            Job.objects.filter(models.Q(priority__in=lower) | models.Q(attempts__gte=settings.JOB_MAX_ATTEMPTS),
+                               submission=submission, os__in=oses, available_date__lte=timezone.now()).delete()
+            Job.objects.bulk_create([
+                job for os in oses for job in Job.plan(os, [(submission.pk, submission.uploader_id)], priority)
+            ], ignore_conflicts=True)
+
+    @staticmethod
+    def claim(os, user, count):
+        """
+        Atomically leases the first count available jobs for os to user, in sort_key order.
+        Jobs claimed JOB_MAX_ATTEMPTS times without a run being recorded are parked and skipped.
+        """
+        now = timezone.now()
+        token = secrets.token_hex(16)
+        with transaction.atomic():
+            ids = list(Job.objects.filter(os=os, available_date__lte=now, attempts__lt=settings.JOB_MAX_ATTEMPTS)
+                       .order_by('sort_key', 'id')
+                       .values_list('id', flat=True)[:count])
+            # Re-checking availability in the update means a concurrent claim can't take the same rows
+            Job.objects.filter(id__in=ids, available_date__lte=now).update(
+                lease_owner=user,
+                lease_token=token,
+                available_date=now + settings.JOB_LEASE_TIME,
+                attempts=F('attempts') + 1,
+            )
+        return Job.objects.filter(lease_token=token).order_by('sort_key', 'id')
+
+    def renew(self, lease_token) -> bool:
+        """Extends the lease claimed with lease_token, returns False if it has already been handed to someone else."""
+        available_date = timezone.now() + settings.JOB_LEASE_TIME
+        if Job.objects.filter(pk=self.pk, lease_token=lease_token).update(available_date=available_date) != 1:
+            return False
+        self.available_date = available_date
+        return True
+
+    def release(self, lease_token) -> bool:
+        """Hands the job back for someone else to claim, returns False if lease_token no longer holds it."""
+        available_date = timezone.now()
+        if Job.objects.filter(pk=self.pk, lease_token=lease_token).update(
+                available_date=available_date, lease_owner=None, lease_token=None) != 1:
+            return False
+        self.available_date = available_date
+        self.lease_owner = None
+        self.lease_token = None
+        return True
+
+
+class RunnerHeartbeat(models.Model):
+    """
+    When a runner (a user verifying on one OS label) last asked for work and posted
+    results, with a rolling estimate of its throughput.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE)
+    os = models.TextField('OS', max_length=32)
+    last_poll = models.DateTimeField('Last Poll', default=None, null=True)
+    last_result = models.DateTimeField('Last Result', default=None, null=True)
+    # Decaying rate as of last_result, see add_results
+    run_rate = models.FloatField('Runs per Minute', default=0)
+    mean_duration = models.FloatField('Mean Run Duration', default=None, null=True)
+
+    # Time constant of the run rate, in minutes
+    RATE_WINDOW = 10
+    # Weight of each new run in the mean duration
+    DURATION_WEIGHT = 0.1
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'os'], name='unique_runner_heartbeat'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} ({self.os})"
+
+    @staticmethod
+    def poll(user, os):
+        now = timezone.now()
+        if RunnerHeartbeat.objects.filter(user=user, os=os).update(last_poll=now) == 0:
+            RunnerHeartbeat.objects.get_or_create(user=user, os=os, defaults={'last_poll': now})
+
+    @staticmethod
+    def add_results(user, os, runs):
+        """Folds newly posted runs into the runner's run rate and mean duration."""
+        now = timezone.now()
+        with transaction.atomic():
+            heartbeat, _ = RunnerHeartbeat.objects.select_for_update().get_or_create(user=user, os=os)
+            heartbeat.run_rate = heartbeat.current_run_rate(now) + len(runs) / RunnerHeartbeat.RATE_WINDOW
+            heartbeat.last_result = now
+            for run in runs:
+                if run.duration is None:
+                    continue
+                if heartbeat.mean_duration is None:
+                    heartbeat.mean_duration = run.duration
+                else:
+                    heartbeat.mean_duration += RunnerHeartbeat.DURATION_WEIGHT * (run.duration - heartbeat.mean_duration)
+            heartbeat.save()
+
+    def current_run_rate(self, now=None):
+        """Runs per minute, decayed from the last result until now."""
+        if self.last_result is None:
+            return 0
+        if now is None:
+            now = timezone.now()
+        minutes = (now - self.last_result).total_seconds() / 60
+        return self.run_rate * math.exp(-minutes / RunnerHeartbeat.RATE_WINDOW)
+
+    @staticmethod
+    def throughput(os, now=None):
+        """Runs per minute between every runner for os that has posted results recently."""
+        if now is None:
+            now = timezone.now()
+        heartbeats = RunnerHeartbeat.objects.filter(os=os, last_result__gte=now - settings.RUNNER_LIVE_TIME)
+        return sum(heartbeat.current_run_rate(now) for heartbeat in heartbeats)
+
+    @property
+    def last_seen(self):
+        return max(date for date in [self.last_poll, self.last_result] if date is not None)
+
+    @property
+    def is_stalled(self):
+        return timezone.now() - self.last_seen > settings.RUNNER_STALL_TIME
+
+    @staticmethod
+    def live():
+        since = timezone.now() - settings.RUNNER_LIVE_TIME
+        return RunnerHeartbeat.objects.filter(models.Q(last_poll__gte=since) | models.Q(last_result__gte=since)) \
+            .select_related('user').order_by('user__username', 'os')
+
+
+class Campaign(models.Model):
+    """
+    Re-verification of past submissions on a new OS label, compared against a baseline label.
+    Rather than queueing everything at once, each claim for the OS tops the campaign up by as
+    many jobs as its rate limit allows, keeping at most max_pending of them queued.
+    """
+
+    class Status(models.TextChoices):
+        ACTIVE = 'active', 'Active'
+        PAUSED = 'paused', 'Paused'
+        COMPLETE = 'complete', 'Complete'
+
+    name = models.TextField('Name')
+    os = models.TextField('OS', max_length=32)
+    baseline_os = models.TextField('Baseline OS', max_length=32)
+    # Which submissions to run, each optional: a level name (from earlier runs) and an upload date range
+    level = models.TextField('Level', default=None, null=True, blank=True)
+    uploaded_after = models.DateTimeField('Uploaded After', default=None, null=True, blank=True)
+    uploaded_before = models.DateTimeField('Uploaded Before', default=None, null=True, blank=True)
+    # Most jobs queued per hour, or None for as fast as the runners go
+    rate_limit = models.IntegerField('Jobs per Hour', default=None, null=True, blank=True)
+    max_pending = models.IntegerField('Max Pending Jobs', default=100)
+    status = models.CharField('Status', max_length=16, choices=Status.choices, default=Status.ACTIVE)
+    created_date = models.DateTimeField('Created Date')
+    completed_date = models.DateTimeField('Completed Date', default=None, null=True)
+    # Submissions are queued in id order; the last one queued so far
+    position = models.BigIntegerField('Position', default=0)
+    # How many submissions had no run on os when the campaign was created
+    total = models.IntegerField('Total', default=0)
+    queued = models.IntegerField('Queued', default=0)
+    # Token bucket for rate_limit, as of last_top_up
+    allowance = models.FloatField('Allowance', default=0)
+    last_top_up = models.DateTimeField('Last Top Up', default=None, null=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.os} vs {self.baseline_os})"
+
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            self.created_date = timezone.now()
+            self.total = self.remaining().count()
+            # Starts with a full bucket
+            self.allowance = self.max_pending
+        super().save(*args, **kwargs)
+
+    def scope(self):
+        """Every submission the campaign covers, run on os or not."""
+        submissions = Submission.objects.all()
+        if self.level:
+            submissions = submissions.filter(id__in=Run.objects.filter(score__level_name__iexact=self.level).values('submission_id'))
+        if self.uploaded_after is not None:
+            submissions = submissions.filter(upload_date__gte=self.uploaded_after)
+        if self.uploaded_before is not None:
+            submissions = submissions.filter(upload_date__lte=self.uploaded_before)
+        return submissions
+
+    def remaining(self):
+        return self.scope().exclude(runs__os=self.os)
+
+    def top_up(self, now=None):
+        """
+        Queues the next submissions that have no run or job on os yet, as many as the rate limit
+        has allowed since the last top up and max_pending leaves room for. Once there are none
+        left and every job has been run, the campaign is complete.
+        """
+        if now is None:
+            now = timezone.now()
+        # Parked jobs are left for an admin, rather than holding up the rest of the campaign
+        pending = self.jobs.filter(attempts__lt=settings.JOB_MAX_ATTEMPTS).count()
+
+        allowance = self.max_pending
+        if self.rate_limit is not None:
+            hours = 0 if self.last_top_up is None else (now - self.last_top_up).total_seconds() / 3600
+            allowance = min(self.allowance + hours * self.rate_limit, self.max_pending)
+        count = min(int(allowance), self.max_pending - pending)
+
+        entries = []
+        if count > 0:
+            entries = list(self.remaining().exclude(jobs__os=self.os).filter(id__gt=self.position)
+                           .order_by('id').values_list('id', 'uploader_id')[:count])
+        complete = count > 0 and len(entries) == 0 and pending == 0
+
+        jobs = Job.plan(self.os, entries, Job.Priority.BACKFILL)
+        for job in jobs:
+            job.campaign = self
+        with transaction.atomic():
+            # Only one of several runners claiming at once gets to move the position on
+            updated = Campaign.objects.filter(pk=self.pk, position=self.position, status=Campaign.Status.ACTIVE).update(
+                position=entries[-1][0] if entries else self.position,
+                allowance=allowance - len(entries),
+                last_top_up=now,
+                queued=F('queued') + len(entries),
+                status=Campaign.Status.COMPLETE if complete else Campaign.Status.ACTIVE,
+                completed_date=now if complete else None,
+            )
+            if updated == 1:
+                Job.objects.bulk_create(jobs, ignore_conflicts=True)
+
+    @staticmethod
+    def top_up_all(os):
+        for campaign in Campaign.objects.filter(os=os, status=Campaign.Status.ACTIVE):
+            campaign.top_up()
+
+    def pause(self):
+        """Stops topping up and takes the unclaimed jobs off the queue; claimed ones still finish."""
+        with transaction.atomic():
+            unclaimed = self.jobs.filter(available_date__lte=timezone.now())
+            first = unclaimed.aggregate(first=models.Min('submission_id'))['first']
+            unclaimed.delete()
+            # Back to before the first job taken off, so those are queued again on resume
+            if first is not None:
+                self.position = min(self.position, first - 1)
+            self.status = Campaign.Status.PAUSED
+            self.save(update_fields=['position', 'status'])
+
+    def resume(self):
+        # Time spent paused doesn't count towards the rate limit
+        self.status = Campaign.Status.ACTIVE
+        self.last_top_up = timezone.now()
+        self.save(update_fields=['status', 'last_top_up'])
+
+    def progress(self, now=None):
+        """How far along the campaign is, and when it should be done at the rate runners for os are going."""
+        if now is None:
+            now = timezone.now()
+        remaining = self.remaining().count()
+        rate = RunnerHeartbeat.throughput(self.os, now)
+        if self.rate_limit is not None:
+            rate = min(rate, self.rate_limit / 60)
+        eta = None
+        if self.status == Campaign.Status.ACTIVE and remaining > 0 and rate > 0:
+            eta = now + datetime.timedelta(minutes=remaining / rate)
+        return {
+            'total': self.total,
+            'done': max(self.total - remaining, 0),
+            'remaining': remaining,
+            'pending': self.jobs.count(),
+            'runs_per_minute': rate,
+            'eta': eta,
+        }
+
+    def report(self, limit=100):
+        """Discrepancies between os and baseline_os among the campaign's submissions."""
+        compared = self.scope().filter(runs__os=self.os).filter(runs__os=self.baseline_os).distinct()
+        report = {'compared': compared.count()}
+        for kind in Discrepancy.Kind:
+            differences = Discrepancy.between(self.os, self.baseline_os, kind).filter(submission__in=self.scope())
+            report[kind.value] = {
+                'count': differences.count(),
+                'submissions': list(differences.order_by('upload_date').values('submission_id', 'submission__name')[:limit]),
+            }
+        return report
+
+
+# Derived state is maintained by tasks, imported here because they import the models
+
+@receiver(post_save, sender=Submission)
+def submission_saved(sender, instance, created, raw, **kwargs):
+    from recapp import tasks
+    if raw:
+        return
+    if created:
+        tasks.schedule(tasks.derive_submission, instance.pk)
+    else:
+        tasks.schedule(tasks.refresh_desync, instance.pk)
+
+
+@receiver(post_save, sender=Run)
+def run_saved(sender, instance, created, raw, **kwargs):
+    from recapp import tasks
+    if created and not raw:
+        tasks.schedule(tasks.refresh_submission, instance.submission_id)
+
+
+@receiver(post_delete, sender=Run)
+def run_deleted(sender, instance, **kwargs):
+    from recapp import tasks
+    tasks.schedule(tasks.refresh_submission, instance.submission_id)
+
+
+@receiver(post_save, sender=Submission)
+@receiver(post_delete, sender=Submission)
+@receiver(post_save, sender=Run)
+@receiver(post_delete, sender=Run)
+@receiver(post_save, sender=Score)
+@receiver(post_delete, sender=Score)
+def invalidate_cache(sender, **kwargs):
+    caching.invalidate()
+
 
 class Plugin(models.Model):
     file = models.FileField('File', upload_to=str(settings.UPLOADS_PATH), max_length=255)
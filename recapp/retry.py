@@ -0,0 +1,37 @@
+import functools
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+
+
+def is_lock_error(error):
+    return 'database is locked' in str(error) or 'database table is locked' in str(error)
+
+
+def retry_on_lock(func):
+    """
+    Reruns func with exponential backoff while SQLite reports the database as locked.
+
+    Meant for views and other outermost callers: inside a transaction the error has to reach
+    the outermost atomic() block before the work can be retried, so it is re-raised there.
+    Each attempt runs in one transaction, so a view that would otherwise commit several
+    (recording runs, then the runner's heartbeat) is retried all or nothing.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        delay = settings.DATABASE_LOCK_BACKOFF
+        for attempt in range(settings.DATABASE_LOCK_RETRIES + 1):
+            try:
+                if connection.in_atomic_block:
+                    return func(*args, **kwargs)
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except OperationalError as e:
+                if connection.in_atomic_block or not is_lock_error(e) or attempt == settings.DATABASE_LOCK_RETRIES:
+                    raise
+            # Jitter so that writers that collided don't collide again
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay *= 2
+    return wrapper
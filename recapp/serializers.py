@@ -11,7 +11,7 @@ from rest_framework.reverse import reverse
 
 from RecTester import settings
 from .mixins import WriteOnceMixin
-from .models import Submission, Score, Run
+from .models import Submission, Score, Run, Job, RunnerHeartbeat, Campaign
 
 
 class ScoreSerializer(serializers.ModelSerializer):
@@ -25,40 +25,68 @@ class RunSerializer(serializers.ModelSerializer):
     score = ScoreSerializer(many=False, allow_null=True)
     class Meta:
         model = Run
-        fields = ['id', 'url', 'os', 'score', 'error']
+        fields = ['id', 'url', 'os', 'score', 'error', 'error_kind', 'duration']
 
     def get_url(self, obj):
-        submission = obj.submission
-        return reverse('run-detail', args=[submission.pk, obj.pk], request=self.context['request'])
+        return reverse('run-detail', args=[obj.submission_id, obj.pk], request=self.context['request'])
 
-    def create(self, validated_data):
-        if (validated_data['score'] is None) == (validated_data['error'] is None):
+    def validate(self, attrs):
+        if (attrs.get('score') is None) == (attrs.get('error') is None):
             raise ValidationError('Need either score or error, but not both')
+        if attrs.get('error_kind') is not None and attrs.get('error') is None:
+            raise ValidationError('Error kind given without an error')
+        return attrs
 
-        if validated_data['score'] is not None:
-            score_fields = validated_data['score']
-            validated_data['score'] = None
-            instance = Run(**validated_data)
-            instance.score = Score(run=instance, **score_fields)
-            instance.score.save()
-        else:
-            instance = Run(**validated_data)
-
-        instance.run_date = timezone.now()
-        instance.submission.runs.add(instance, bulk=False)
+    def create(self, validated_data):
+        instance = RunSerializer.build(validated_data)
+        Run.record([instance])
+        return instance
 
+    @staticmethod
+    def build(validated_data):
+        score_fields = validated_data.pop('score', None)
+        instance = Run(**validated_data)
+        if score_fields is not None:
+            instance.score = Score(**score_fields)
         return instance
 
 
+class BatchSubmissionField(serializers.PrimaryKeyRelatedField):
+    """Looks submissions up in context['submissions'], loaded for the whole batch at once, instead of one query per item."""
+
+    def to_internal_value(self, data):
+        submissions = self.context.get('submissions')
+        if submissions is None:
+            return super().to_internal_value(data)
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk not in submissions:
+            self.fail('does_not_exist', pk_value=data)
+        return submissions[pk]
+
+
+class RunBatchItemSerializer(RunSerializer):
+    submission = BatchSubmissionField(queryset=Submission.objects.all())
+
+    class Meta:
+        model = Run
+        fields = ['id', 'url', 'submission', 'os', 'score', 'error', 'error_kind', 'duration']
+
+
 class SubmissionSerializer(WriteOnceMixin, serializers.HyperlinkedModelSerializer):
     download_url = serializers.HyperlinkedIdentityField(view_name='submission-download')
     runs = RunSerializer(many=True, read_only=True)
     runs_url = serializers.SerializerMethodField()
+    best_run = serializers.PrimaryKeyRelatedField(read_only=True)
 
     class Meta:
         model = Submission
-        fields = ['id', 'url', 'name', 'hash', 'file', 'file_name', 'download_url', 'upload_date', 'expected_time', 'runs', 'runs_url']
-        read_only_fields = ['upload_date', 'name', 'hash']
+        fields = ['id', 'url', 'name', 'hash', 'file', 'file_name', 'download_url', 'upload_date', 'expected_time', 'best_run', 'best_score_time', 'runs', 'runs_url']
+        read_only_fields = ['upload_date', 'name', 'hash', 'best_score_time']
         write_once_fields = ['file']
         extra_kwargs = {
             'file': {'write_only': True}
@@ -74,6 +102,54 @@ class SubmissionSerializer(WriteOnceMixin, serializers.HyperlinkedModelSerialize
         return reverse('run-list', args=[obj.pk], request=self.context['request'])
 
 
+class JobSerializer(serializers.ModelSerializer):
+    submission = SubmissionSerializer(read_only=True)
+    lease_expires = serializers.DateTimeField(source='available_date', read_only=True)
+    # Sent back to renew or release the lease, so only shown to the runner holding it
+    lease_token = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = ['id', 'os', 'submission', 'priority', 'enqueue_date', 'lease_expires', 'lease_token', 'attempts']
+
+    def get_lease_token(self, obj):
+        request = self.context.get('request')
+        if request is None or obj.lease_owner_id != request.user.id:
+            return None
+        return obj.lease_token
+
+
+class RunnerHeartbeatSerializer(serializers.ModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
+    runs_per_minute = serializers.SerializerMethodField()
+    is_stalled = serializers.BooleanField(read_only=True)
+
+    class Meta:
+        model = RunnerHeartbeat
+        fields = ['username', 'os', 'last_poll', 'last_result', 'runs_per_minute', 'mean_duration', 'is_stalled']
+
+    def get_runs_per_minute(self, obj):
+        return obj.current_run_rate()
+
+
+class CampaignSerializer(serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Campaign
+        fields = ['id', 'name', 'os', 'baseline_os', 'level', 'uploaded_after', 'uploaded_before', 'rate_limit',
+                  'max_pending', 'status', 'created_date', 'completed_date', 'queued', 'progress']
+        read_only_fields = ['status', 'created_date', 'completed_date', 'queued']
+
+    def get_progress(self, obj):
+        return obj.progress()
+
+    def validate(self, attrs):
+        if attrs.get('os') == attrs.get('baseline_os'):
+            raise ValidationError({'baseline_os': 'Must be a different OS from os'})
+        return attrs
+
+
 class UserSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = User
@@ -1,18 +1,68 @@
+import hashlib
 import json
 import re
 
 import os
 import platform
+import signal
 import subprocess
+import tempfile
+import threading
 import traceback
 import random
-from time import sleep
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 
 import requests
 from requests.exceptions import ConnectionError
 
 
-def exec_run_wine(file):
+def kill_process_group(process):
+    """Kills the process and everything it started (wine spawns its own helpers)."""
+    if os.name == 'posix':
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def exec_recverify(cmd, cwd, timeout, on_line):
+    """
+    Runs recverify, passing each line of its stdout to on_line as soon as it is printed.
+    After `timeout` seconds its whole process group is killed. Returns (exit code, timed out).
+    """
+    if os.name == 'posix':
+        group = {'start_new_session': True}
+    else:
+        group = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, **group)
+
+    timed_out = threading.Event()
+
+    def expire():
+        timed_out.set()
+        kill_process_group(process)
+
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+    try:
+        for line in process.stdout:
+            on_line(line.rstrip(b'\r\n'))
+        code = process.wait()
+    finally:
+        timer.cancel()
+        if process.poll() is None:
+            kill_process_group(process)
+            process.wait()
+        process.stdout.close()
+    return code, timed_out.is_set()
+
+
+def exec_run_wine(file, timeout, on_line):
     cmd = [
         'wine',
         os.environ['RUNNER_RECVERIFY_PATH'],
@@ -21,11 +71,10 @@ def exec_run_wine(file):
     ]
     cwd = os.environ['RUNNER_MBG_PATH']
 
-    result = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return result.returncode, result.stdout
+    return exec_recverify(cmd, cwd, timeout, on_line)
 
 
-def exec_run_mac(file):
+def exec_run_mac(file, timeout, on_line):
     if [int(v) for v in platform.mac_ver()[0].split('.')] >= [10, 15, 0]:
         raise RuntimeError("Cannot run Marble Blast natively on macOS >= Catalina")
 
@@ -36,11 +85,10 @@ def exec_run_mac(file):
     ]
     cwd = os.environ['RUNNER_MBG_PATH']
 
-    result = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return result.returncode, result.stdout
+    return exec_recverify(cmd, cwd, timeout, on_line)
 
 
-def exec_run_windows(file):
+def exec_run_windows(file, timeout, on_line):
     cmd = [
         os.environ['RUNNER_RECVERIFY_PATH'],
         '--auto',
@@ -48,8 +96,16 @@ def exec_run_windows(file):
     ]
     cwd = os.environ['RUNNER_MBG_PATH']
 
-    result = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return result.returncode, result.stdout
+    return exec_recverify(cmd, cwd, timeout, on_line)
+
+
+def run_timeout(submission):
+    """Seconds a run of submission may take before it is killed: a multiple of its expected time, plus slack."""
+    factor = float(os.environ.get('RUNNER_TIMEOUT_FACTOR', 3))
+    slack = float(os.environ.get('RUNNER_TIMEOUT_SLACK', 120))
+    if submission.get('expected_time') is None:
+        return float(os.environ.get('RUNNER_TIMEOUT_DEFAULT', 900))
+    return submission['expected_time'] / 1000 * factor + slack
 
 
 def collapse_escape(text):
@@ -67,28 +123,32 @@ def collapse_escape(text):
     return text
 
 
-def start_run(file):
+def start_run(file, timeout):
+    """Runs file through recverify, returns (score fields, error message, error kind)."""
+    # Everything from the STATUS line on is "KEY: value". Only the tail of the output
+    # is kept for error messages, in case a hung recverify keeps printing
+    output = deque(maxlen=200)
+    info = {}
+
+    def on_line(line):
+        output.append(line)
+        if line.startswith(b'STATUS: ') or b'STATUS' in info:
+            key, _, value = line.partition(b': ')
+            info[key] = value
+
     if os.environ['RUNNER_OS'] == 'wine':
-        code, stdout = exec_run_wine(file)
+        code, timed_out = exec_run_wine(file, timeout, on_line)
     elif os.environ['RUNNER_OS'] == 'mac':
-        code, stdout = exec_run_mac(file)
+        code, timed_out = exec_run_mac(file, timeout, on_line)
     elif os.environ['RUNNER_OS'] == 'windows':
-        code, stdout = exec_run_windows(file)
+        code, timed_out = exec_run_windows(file, timeout, on_line)
     else:
         raise NotImplementedError("Unknown OS")
 
-    if code != 0:
-        return None, stdout.decode()
-
-    stdout_lines = stdout.split(b'\n')
-    status = None
-    for line in stdout_lines:
-        if line.startswith(b'STATUS: '):
-            status = line.endswith(b'SUCCESS')
-            break
-
-    if status is None:
-        return None, stdout.decode()
+    if timed_out:
+        return None, f'Timed out after {timeout:.0f}s\n' + b'\n'.join(output).decode(errors='replace'), 'timeout'
+    if code != 0 or b'STATUS' not in info:
+        return None, b'\n'.join(output).decode(errors='replace'), 'crash'
 
     # Parse successful run
     '''
@@ -105,10 +165,6 @@ def start_run(file):
     TOTAL RECORDING FRAMES: 18624
     TOTAL RECORDING FPS: 897.88837
     '''
-    info = {}
-    for line in stdout_lines[1:]:
-        info[line.split(b': ')[0]] = b': '.join(line.split(b': ')[1:])
-
     if info[b'STATUS'] == b'SUCCESS':
         db_info = {
             'success':      info[b'STATUS'] == b'SUCCESS',
@@ -124,7 +180,7 @@ def start_run(file):
             'frames_time':  int(info[b'TOTAL RECORDING TIME'].split(b' ')[0]),
         }
 
-        return db_info, None
+        return db_info, None, None
     else:
         db_info = {
             'success':      info[b'STATUS'] == b'SUCCESS',
@@ -140,35 +196,263 @@ def start_run(file):
             'frames_time':  int(info[b'TOTAL RECORDING TIME'].split(b' ')[0]),
         }
 
-        return db_info, None
+        return db_info, None, None
 
 
-def respond_to_submission(token, submission):
-    download_url = submission['download_url']
-    download_path = f'downloads/{submission["file_name"]}'
+thread_sessions = threading.local()
 
-    if not os.path.exists('downloads'):
-        os.mkdir('downloads')
-    if os.path.exists(download_path):
-        os.unlink(download_path)
 
-    with requests.get(download_url, headers={'Authorization': f'Token {token}'}, stream=True) as req:
-        req.raise_for_status()
-        with open(download_path, 'wb') as f:
-            for chunk in req.iter_content(chunk_size=8192):
-                f.write(chunk)
+def session(token):
+    """A keep-alive session for the calling thread, authenticated with token."""
+    if getattr(thread_sessions, 'session', None) is None:
+        thread_sessions.session = requests.Session()
+        thread_sessions.session.headers['Authorization'] = f'Token {token}'
+    return thread_sessions.session
 
-    score, error = start_run(download_path)
-    db_os = os.environ['RUNNER_OS']
 
-    db_run = {
-        'os': db_os,
-        'score': score,
-        'error': error
-    }
+class RecCache:
+    """
+    Downloaded recs, stored by content hash so that they survive restarts and can be
+    shared by runners for different OS labels on the same machine. Files are checked
+    against their hash before they are added, and the least recently used ones are
+    deleted once the cache grows past `max_size` bytes. Files handed out by get() are
+    kept until they are released, but only by this process: another runner sharing the
+    directory can still evict them, so check() downloads a missing file again.
+    """
 
-    run_response = requests.post(submission['runs_url'], headers={'Authorization': f'Token {token}'}, json=db_run)
-    print(run_response.text)
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.pinned = {}
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, file_hash):
+        return os.path.join(self.root, f'{file_hash}.rec')
+
+    def get(self, token, submission):
+        """Path of the submission's rec, downloaded unless it is already cached. Release it when done."""
+        file_hash = submission['hash']
+        path = self.path(file_hash)
+        with self.lock:
+            self.pinned[file_hash] = self.pinned.get(file_hash, 0) + 1
+        try:
+            # Touching the file marks it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            try:
+                self.download(token, submission, path)
+            except:
+                self.release(submission)
+                raise
+            self.evict()
+        return path
+
+    def check(self, token, submission):
+        """Path of a rec handed out by get(), downloaded again if another runner has evicted it since."""
+        path = self.path(submission['hash'])
+        if not os.path.exists(path):
+            self.download(token, submission, path)
+        return path
+
+    def release(self, submission):
+        with self.lock:
+            self.pinned[submission['hash']] -= 1
+            if self.pinned[submission['hash']] == 0:
+                del self.pinned[submission['hash']]
+
+    def download(self, token, submission, path):
+        digest = hashlib.sha256()
+        handle, part_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+            with os.fdopen(handle, 'wb') as f, session(token).get(submission['download_url'], stream=True) as req:
+                req.raise_for_status()
+                for chunk in req.iter_content(chunk_size=8192):
+                    digest.update(chunk)
+                    f.write(chunk)
+            if digest.hexdigest() != submission['hash']:
+                raise ValueError(f'Downloaded rec for submission {submission["id"]} does not match its hash')
+            # mkstemp files are private, but runners for other OS labels may run as other users
+            os.chmod(part_path, 0o644)
+            # Atomic, so other threads and runners never see a partial file
+            os.replace(part_path, path)
+        except:
+            os.unlink(part_path)
+            raise
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.endswith('.rec'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.name[:-len('.rec')]))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, file_hash in sorted(entries):
+            if total <= self.max_size:
+                break
+            with self.lock:
+                if file_hash in self.pinned:
+                    continue
+                try:
+                    os.unlink(self.path(file_hash))
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+def post_runs(token, root, results):
+    """Posts a batch of (submission, score, error, error kind, duration) results in one request, returns the per-item statuses."""
+    db_runs = []
+    for submission, score, error, error_kind, duration in results:
+        db_runs.append({
+            'submission': submission['id'],
+            'os': os.environ['RUNNER_OS'],
+            'score': score,
+            'error': error,
+            'error_kind': error_kind,
+            'duration': duration
+        })
+
+    runs_response = session(token).post(f'{root}/runs/bulk/', json=db_runs)
+    runs_response.raise_for_status()
+    return runs_response.json()
+
+
+class JobPool:
+    """
+    Runs claimed jobs through three stages: downloads (prefetched ahead of the runs),
+    up to `concurrency` recverify processes at once, and result uploads in the
+    background. Results are posted in batches of `batch_size`, or every
+    `flush_interval` seconds, whichever comes first.
+    """
+
+    def __init__(self, token, root, cache, concurrency, prefetch, batch_size, flush_interval):
+        self.token = token
+        self.root = root
+        self.cache = cache
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.results = []
+        self.last_flush = monotonic()
+
+        self.downloads = ThreadPoolExecutor(max_workers=max(1, prefetch), thread_name_prefix='download')
+        self.runs = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='run')
+        self.uploads = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload')
+
+    def free_slots(self):
+        with self.lock:
+            return self.concurrency + self.prefetch - len(self.in_flight)
+
+    def submit(self, job):
+        with self.lock:
+            self.in_flight[job['id']] = job
+        self.downloads.submit(self._download, job)
+
+    def _finish(self, job):
+        with self.lock:
+            self.in_flight.pop(job['id'], None)
+
+    def _release(self, job):
+        try:
+            session(self.token).post(f'{self.root}/jobs/{job["id"]}/release/', json={'lease_token': job['lease_token']})
+        except ConnectionError:
+            pass
+        self._finish(job)
+
+    def _download(self, job):
+        submission = job['submission']
+        try:
+            download_path = self.cache.get(self.token, submission)
+        except:
+            # The lease runs out and the job is handed out again later
+            traceback.print_exc()
+            print(f'Error loading submission {submission["id"]}!')
+            self._finish(job)
+            return
+
+        if self.stopping.is_set():
+            self.cache.release(submission)
+            self._release(job)
+            return
+        self.runs.submit(self._run, job, download_path)
+
+    def _run(self, job, download_path):
+        submission = job['submission']
+        try:
+            started = monotonic()
+            score, error, error_kind = start_run(self.cache.check(self.token, submission), run_timeout(submission))
+            if error_kind == 'crash' and not os.path.exists(download_path):
+                # Evicted by another runner before recverify opened it, which says nothing about the rec
+                started = monotonic()
+                score, error, error_kind = start_run(self.cache.check(self.token, submission), run_timeout(submission))
+            duration = monotonic() - started
+        except:
+            traceback.print_exc()
+            print(f'Error running submission {submission["id"]}!')
+            self._finish(job)
+            return
+        finally:
+            self.cache.release(submission)
+        with self.lock:
+            self.results.append((submission, score, error, error_kind, duration))
+            full = len(self.results) >= self.batch_size
+        # The run slot is free again as soon as its result is queued
+        self._finish(job)
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch = self.results
+            self.results = []
+            self.last_flush = monotonic()
+        if len(batch) > 0:
+            self.uploads.submit(self._upload, batch)
+
+    def flush_if_due(self):
+        if monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def _upload(self, batch):
+        try:
+            statuses = post_runs(self.token, self.root, batch)
+        except:
+            # Their leases run out and the jobs are handed out again later
+            traceback.print_exc()
+            print(f'Error posting runs for submissions {[submission["id"] for submission, _, _, _, _ in batch]}!')
+            return
+        for (submission, _, _, _, _), status in zip(batch, statuses):
+            if status['status'] == 201:
+                print(f'Posted run for submission {submission["id"]}')
+            else:
+                print(f'Error posting run for submission {submission["id"]}: {status["errors"]}')
+
+    def renew_leases(self):
+        with self.lock:
+            jobs = list(self.in_flight.values())
+        for job in jobs:
+            try:
+                session(self.token).post(f'{self.root}/jobs/{job["id"]}/renew/', json={'lease_token': job['lease_token']})
+            except ConnectionError:
+                pass
+
+    def shutdown(self):
+        """Stops starting new runs, releases prefetched jobs and waits for in-progress runs to post."""
+        self.stopping.set()
+        self.downloads.shutdown(wait=True)
+        self.runs.shutdown(wait=True)
+        self.flush()
+        self.uploads.shutdown(wait=True)
 
 
 def main():
@@ -210,28 +494,58 @@ def main():
     else:
         raise Exception('Cannot auth!')
 
-    failed_submissions = []
-    while True:
+    concurrency = int(os.environ.get('RUNNER_CONCURRENCY', os.cpu_count() or 1))
+    prefetch = int(os.environ.get('RUNNER_PREFETCH', 2))
+    batch_size = int(os.environ.get('RUNNER_BATCH_SIZE', 10))
+    flush_interval = int(os.environ.get('RUNNER_FLUSH_INTERVAL', 10))
+    renew_interval = 5 * 60
+
+    # Shared by the runners of every OS label on this machine
+    cache = RecCache(os.environ.get('RUNNER_CACHE_PATH', 'downloads'),
+                     int(os.environ.get('RUNNER_CACHE_SIZE', 1024)) * 1024 * 1024)
+
+    pool = JobPool(token, root, cache, concurrency, prefetch, batch_size, flush_interval)
+
+    def stop(signum, frame):
+        print('Shutting down, waiting for running jobs to finish...')
+        pool.stopping.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    last_renew = monotonic()
+    while not pool.stopping.is_set():
+        if monotonic() - last_renew > renew_interval:
+            pool.renew_leases()
+            last_renew = monotonic()
+
+        pool.flush_if_due()
+
+        count = pool.free_slots()
+        if count <= 0:
+            pool.stopping.wait(1)
+            continue
+
         try:
-            submissions_response = requests.get(f'{root}/pending_submissions/{os.environ["RUNNER_OS"]}/',
-                                                headers={'Authorization': f'Token {token}'})
-            print(submissions_response.content)
-            submissions_response = json.loads(submissions_response.text)
+            claim_response = session(token).post(f'{root}/jobs/claim/{os.environ["RUNNER_OS"]}/',
+                                                 json={'count': count})
+            print(claim_response.content)
+            jobs = json.loads(claim_response.text)
         except ConnectionError:
-            sleep(random.randint(5, 25))
+            pool.stopping.wait(random.randint(5, 25))
             continue
-        for submission in submissions_response['results']:
-            if submission['id'] in failed_submissions:
-                continue
-
-            try:
-                respond_to_submission(token, submission)
-            except:
-                traceback.print_exc()
-                print(f'Error loading submission {submission["id"]}!')
-                failed_submissions.append(submission['id'])
-        sleep(random.randint(5, 25))
-
+        for job in jobs:
+            pool.submit(job)
+        if len(jobs) == 0:
+            # Nothing else is coming for a while, so don't hold on to finished results
+            pool.flush()
+            if pool.free_slots() < concurrency + prefetch:
+                # Come back in time to flush the results of the jobs still running
+                pool.stopping.wait(min(random.randint(5, 25), flush_interval))
+            else:
+                pool.stopping.wait(random.randint(5, 25))
+
+    pool.shutdown()
 
 if __name__ == '__main__':
     main()
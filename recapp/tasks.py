@@ -1,7 +1,89 @@
-from celery import Celery
+import logging
 
-app = Celery('tasks', backend='redis://localhost', broker='pyamqp://guest@localhost//')
+from django.conf import settings
+from django.db import transaction, OperationalError
+from django.utils import timezone
 
-@app.task
-def add(x, y):
-    return x + y
\ No newline at end of file
+from RecTester.celery import app
+from recapp import caching
+from recapp.models import Submission, Job, Discrepancy
+from recapp.retry import retry_on_lock
+
+logger = logging.getLogger(__name__)
+
+# Every task recomputes its result from the current rows, so running one twice is harmless,
+# and retrying after the database was locked is safe
+RETRY = {
+    'autoretry_for': (OperationalError,),
+    'retry_backoff': True,
+    'max_retries': 5,
+}
+
+
+def schedule(task, *args):
+    """Queues task once the current transaction commits, so the worker sees the rows it was saved with."""
+    transaction.on_commit(lambda: run_or_delay(task, args))
+
+
+def run_or_delay(task, args):
+    if not settings.CELERY_TASK_ALWAYS_EAGER:
+        task.delay(*args)
+        return
+
+    # Eager autoretries run back to back, and the last error would only be kept in the result.
+    # Called directly, a task raises straight away, so it gets the views' backoff instead
+    try:
+        retry_on_lock(task)(*args)
+    except Exception:
+        # What it derives stays stale until the task runs again, or the matching
+        # command (enqueue_pending, backfill_best_runs, backfill_desync) catches up
+        logger.exception('Task %s%r failed', task.name, tuple(args))
+
+
+@app.task(**RETRY)
+def derive_submission(submission_id):
+    """Guesses what it can from a new submission's file name, and queues it on the verifier OSes it hasn't run on."""
+    submission = Submission.objects.filter(pk=submission_id).first()
+    if submission is None:
+        return
+
+    submission.guess_from_name()
+    # update() rather than save(), which would trigger refresh_desync for every field
+    Submission.objects.filter(pk=submission_id).update(
+        expected_time=submission.expected_time,
+        expected_time_min=submission.expected_time_min,
+        expected_time_max=submission.expected_time_max,
+        is_tas=submission.is_tas,
+        updated_date=timezone.now(),
+    )
+    # Runs may have been posted before this ran
+    submission.refresh_desync()
+
+    ran = set(submission.runs.values_list('os', flat=True))
+    Job.enqueue(submission, [os for os in settings.VERIFIER_OS if os not in ran])
+    caching.invalidate()
+
+
+@app.task(**RETRY)
+def refresh_desync(submission_id):
+    """Recomputes the desync flags of a submission's scores, after its expected time changed."""
+    submission = Submission.objects.filter(pk=submission_id).first()
+    if submission is None:
+        return
+
+    submission.refresh_desync()
+    caching.invalidate()
+
+
+@app.task(**RETRY)
+def refresh_submission(submission_id):
+    """Recomputes a submission's best run and discrepancies, after one of its runs was added or deleted."""
+    submission = Submission.objects.filter(pk=submission_id).first()
+    if submission is None:
+        return
+
+    runs = list(submission.runs.select_related('score'))
+    with transaction.atomic():
+        submission.refresh_best_run(runs)
+        Discrepancy.refresh(submission, runs)
+    caching.invalidate()
@@ -13,6 +13,8 @@ def score(time):
 
 @register.filter(name='run_time')
 def run_time(run: Run):
+    if run.error_kind == Run.ErrorKind.TIMEOUT:
+        return mark_safe("Timed Out")
     if run.error is not None or run.score is None:
         return mark_safe("Errored")
     if not run.score.success:
@@ -20,7 +22,7 @@ def run_time(run: Run):
 
     formatted = score(run.score.score_time)
 
-    if run.score.is_desync:
+    if run.score.desync:
         return mark_safe(f"<span class=\"desync\">{formatted}</span>")
     else:
         return mark_safe(f"{formatted}")
@@ -1,3 +1,566 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import os
+import tempfile
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from recapp import middleware, tasks, views
+from recapp.models import Submission, Run, Score, Job, RunnerHeartbeat, Discrepancy, Campaign
+
+
+def make_score(score_time):
+    return Score(success=True, mission='marble/data/missions/beginner/elevator.mis', level_name='Elevator',
+                 score_time=score_time, elapsed_time=score_time, bonus_time=0, gem_count=0, gem_total=0,
+                 fps=60.0, frames_count=100, frames_time=score_time)
+
+
+class QueryBudgetTests(TestCase):
+    """Fails when a list endpoint's query count starts growing with the number of rows."""
+
+    submission_count = 50
+    oses = ['windows', 'mac', 'windows-newphys221029']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser('runner', 'runner@example.com', 'password')
+
+        runs = []
+        for i in range(cls.submission_count):
+            submission = Submission.objects.create(file=f'uploads/{i:064}.rec', name=f'Elevator_{i}.rec',
+                                                   hash=f'{i:064}', upload_date=timezone.now())
+            Job.enqueue(submission, ['wine'])
+            for os in cls.oses:
+                run = Run(submission=submission, os=os)
+                run.score = make_score(3000 + i)
+                runs.append(run)
+        Run.record(runs)
+
+        # Measure polls from a runner that has been seen before
+        RunnerHeartbeat.poll(cls.user, 'wine')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertQueryBudget(self, url, budget, method='get'):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url)
+        self.assertLess(response.status_code, 300)
+        self.assertLessEqual(len(queries), budget, '\n'.join(query['sql'] for query in queries))
+        return response
+
+    def test_submission_list(self):
+        response = self.assertQueryBudget('/api/submissions/', 4)
+        self.assertEqual(len(response.data['results']), self.submission_count)
+        self.assertEqual(len(response.data['results'][0]['runs']), len(self.oses))
+
+    def test_submission_detail(self):
+        self.assertQueryBudget(f'/api/submissions/{Submission.objects.first().id}/', 3)
+
+    def test_submission_runs(self):
+        self.assertQueryBudget(f'/api/submissions/{Submission.objects.first().id}/runs/', 3)
+
+    def test_pending_submissions(self):
+        response = self.assertQueryBudget('/api/pending_submissions/wine/', 4)
+        self.assertEqual(len(response.data['results']), self.submission_count)
+
+    def test_best(self):
+        self.assertQueryBudget('/best', 3)
+
+    def test_worst(self):
+        self.assertQueryBudget('/worst', 3)
+
+    def test_submission_status(self):
+        url = f'/submissions/{Submission.objects.first().id}/status'
+        response = self.assertQueryBudget(url, 2)
+        self.assertEqual(response.json()['runs'], len(self.oses))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_conditional_get(self):
+        for url in ['/api/submissions/', '/api/submissions/{}/', '/api/pending_submissions/wine/']:
+            # Each pass takes a submission off the wine queue, so one that's still on it
+            submission = Submission.objects.filter(jobs__os='wine').first()
+            url = url.format(submission.id)
+            response = self.client.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertLessEqual(len(queries), 2, '\n'.join(query['sql'] for query in queries))
+            # Dates can't tell deletions or changes within a second apart, so only the ETag is used
+            self.assertNotIn('Last-Modified', response)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE='Sat, 01 Jan 2100 00:00:00 GMT').status_code, 200)
+
+            run = Run(submission=submission, os='wine')
+            run.score = make_score(3000)
+            Run.record([run])
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_conditional_get_after_edit(self):
+        submission = Submission.objects.first()
+        url = f'/api/submissions/{submission.id}/'
+        etag = self.client.get(url)['ETag']
+
+        # Changes no count, like the admin or derive_submission filling in fields later
+        submission.is_tas = True
+        submission.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        Submission.objects.filter(pk=submission.pk).update(name='Elevator_00.03.001.rec')
+        tasks.derive_submission(submission.id)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        submission.runs.first().delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_pending_conditional_get(self):
+        url = '/api/pending_submissions/wine/'
+        etag = self.client.get(url)['ETag']
+
+        # Listed with its runs, so a run on another OS changes the page without touching the queue
+        run = Run(submission=Submission.objects.filter(jobs__os='wine').first(), os='linux')
+        run.score = make_score(3000)
+        Run.record([run])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_export(self):
+        # The stream runs its queries as it is read
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/submissions/export/?format=ndjson')
+            lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), self.submission_count)
+        self.assertEqual(len(json.loads(lines[0])['runs']), len(self.oses))
+        self.assertLessEqual(len(queries), 2, '\n'.join(query['sql'] for query in queries))
+
+    def test_bulk_runs(self):
+        runs = [{'submission': submission.id, 'os': 'wine', 'score': None, 'error': 'Crashed'}
+                for submission in Submission.objects.all()]
+        runs.append({'submission': 0, 'os': 'wine', 'score': None, 'error': 'Crashed'})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/runs/bulk/', runs, format='json')
+        self.assertEqual([result['status'] for result in response.data], [201] * self.submission_count + [400])
+        # Inserts are per row on SQLite, but submissions are looked up once for the batch
+        lookups = [query['sql'] for query in queries if query['sql'].startswith('SELECT') and 'FROM "recapp_submission"' in query['sql']]
+        self.assertEqual(len(lookups), 1, '\n'.join(lookups))
+
+    def test_claim_jobs(self):
+        response = self.client.post('/api/jobs/claim/wine/', {'count': 50}, format='json')
+        self.assertEqual(len(response.data), self.submission_count)
+        self.assertQueryBudget('/api/jobs/', 3)
+
+
+class DerivedStateTests(TestCase):
+    """Tasks run eagerly in tests, once the transaction that queued them commits."""
+
+    def test_new_submission(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            submission = Submission.objects.create(file='uploads/a.rec', name='Elevator_00.03.559.rec', hash='a')
+        submission.refresh_from_db()
+        self.assertEqual(submission.expected_time, 3559)
+        self.assertEqual(set(submission.jobs.values_list('os', flat=True)), set(settings.VERIFIER_OS))
+
+    def test_new_runs(self):
+        submission = Submission.objects.create(file='uploads/a.rec', name='Elevator.rec', hash='a')
+        runs = [Run(submission=submission, os='windows', score=make_score(3000)),
+                Run(submission=submission, os='mac', score=make_score(3001))]
+        with self.captureOnCommitCallbacks(execute=True):
+            Run.record(runs)
+        submission.refresh_from_db()
+        self.assertEqual(submission.best_score_time, 3000)
+        self.assertEqual(Discrepancy.between('mac', 'windows', Discrepancy.Kind.SCORE).count(), 1)
+
+
+class LockRetryTests(TransactionTestCase):
+    """Retried views run outside a test transaction here, as they do when serving requests."""
+
+    def test_bulk_runs_recorded_once(self):
+        runner = User.objects.create_superuser('runner', 'runner@example.com', 'password')
+        submission = Submission.objects.create(file='uploads/a.rec', name='Elevator.rec', hash='a')
+        client = APIClient()
+        client.force_authenticate(runner)
+
+        # The heartbeat update comes after the runs are saved, and is what finds the database locked
+        add_results = RunnerHeartbeat.add_results
+        calls = []
+
+        def locked_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return add_results(*args)
+
+        with mock.patch.object(RunnerHeartbeat, 'add_results', side_effect=locked_once):
+            response = client.post('/api/runs/bulk/', [{'submission': submission.id, 'os': 'wine', 'score': None,
+                                                        'error': 'Crashed'}], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(Run.objects.count(), 1)
+
+    @mock.patch('recapp.retry.time.sleep')
+    def test_eager_task_retried(self, sleep):
+        enqueue = Job.enqueue
+        calls = []
+
+        def locked_twice(*args):
+            calls.append(args)
+            if len(calls) <= 2:
+                raise OperationalError('database is locked')
+            return enqueue(*args)
+
+        with mock.patch.object(Job, 'enqueue', side_effect=locked_twice):
+            submission = Submission.objects.create(file='uploads/a.rec', name='Elevator.rec', hash='a')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(set(submission.jobs.values_list('os', flat=True)), set(settings.VERIFIER_OS))
+
+    @mock.patch('recapp.retry.time.sleep')
+    def test_eager_task_failure_logged(self, sleep):
+        with mock.patch.object(Job, 'enqueue', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('recapp.tasks', 'ERROR') as logs:
+            Submission.objects.create(file='uploads/a.rec', name='Elevator.rec', hash='a')
+        self.assertIn('derive_submission', logs.output[0])
+
+
+class KeysetPageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        for i in range(5):
+            # Two share an upload date, so the id has to break the tie
+            submission = Submission.objects.create(file=f'uploads/{i}.rec', name=f'Elevator_{i}.rec', hash=f'{i}',
+                                                   upload_date=now + datetime.timedelta(seconds=min(i, 3)))
+            runs = [Run(submission=submission, os='windows', score=make_score(3000)),
+                    Run(submission=submission, os='mac', score=make_score(3001))]
+            Run.record(runs)
+            Discrepancy.refresh(submission)
+
+    def page(self, cursor=None):
+        return views.keyset_page(Discrepancy.between('windows', 'mac', Discrepancy.Kind.ANY), cursor, 2)
+
+    def names(self, rows):
+        return [row.submission.name for row in rows]
+
+    def test_forward_and_back(self):
+        rows, next_cursor, previous_cursor = self.page()
+        self.assertEqual(self.names(rows), ['Elevator_0.rec', 'Elevator_1.rec'])
+        self.assertIsNone(previous_cursor)
+
+        rows, next_cursor, previous_cursor = self.page(next_cursor)
+        self.assertEqual(self.names(rows), ['Elevator_2.rec', 'Elevator_3.rec'])
+        rows, last_next, _ = self.page(next_cursor)
+        self.assertEqual(self.names(rows), ['Elevator_4.rec'])
+        self.assertIsNone(last_next)
+
+        rows, _, previous_cursor = self.page(previous_cursor)
+        self.assertEqual(self.names(rows), ['Elevator_0.rec', 'Elevator_1.rec'])
+        self.assertIsNone(previous_cursor)
+
+    def test_compare_links(self):
+        response = self.client.get('/compare/windows/mac?format=json')
+        self.assertEqual(len(response.json()['results']), 5)
+        self.assertIsNone(response.json()['next'])
+
+    def test_bad_cursor(self):
+        for cursor in ['nonsense', 'eDIwMjB8MQ==', '%%%']:
+            self.assertEqual(self.client.get('/compare/windows/mac', {'cursor': cursor}).status_code, 400)
+            self.assertEqual(self.client.get('/compare/windows/mac', {'cursor': cursor, 'format': 'json'}).status_code, 400)
+
+
+class SchedulingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.bulk_user = User.objects.create_user('bulk')
+        cls.user = User.objects.create_user('user')
+        cls.runner = User.objects.create_superuser('runner', 'runner@example.com', 'password')
+
+    def upload(self, name, uploader=None):
+        return Submission.objects.create(file=f'uploads/{name}.rec', name=f'{name}.rec', hash=name, uploader=uploader)
+
+    def claim_order(self):
+        return [job.submission.name for job in Job.claim('wine', self.runner, 100)]
+
+    def test_fair_share(self):
+        for i in range(10):
+            Job.enqueue(self.upload(f'bulk_{i}', self.bulk_user), ['wine'])
+        Job.enqueue(self.upload('single', self.user), ['wine'])
+        self.assertLessEqual(self.claim_order().index('single.rec'), 1)
+
+    def test_priority_and_aging(self):
+        now = timezone.now()
+        with mock.patch('django.utils.timezone.now', return_value=now - settings.JOB_PRIORITY_DELAY['backfill'] * 2):
+            Job.objects.bulk_create(Job.plan('wine', [(self.upload('old_backfill').id, None)], Job.Priority.BACKFILL))
+        Job.objects.bulk_create(Job.plan('wine', [(self.upload('backfill').id, None)], Job.Priority.BACKFILL))
+        Job.enqueue(self.upload('reverify'), ['wine'], Job.Priority.REVERIFY)
+        Job.enqueue(self.upload('fresh'), ['wine'])
+        self.assertEqual(self.claim_order(), ['old_backfill.rec', 'fresh.rec', 'reverify.rec', 'backfill.rec'])
+
+    def test_pending_order(self):
+        for i in range(5):
+            Job.enqueue(self.upload(f'bulk_{i}', self.bulk_user), ['wine'])
+        Job.objects.bulk_create(Job.plan('wine', [(self.upload('backfill').id, None)], Job.Priority.BACKFILL))
+        Job.enqueue(self.upload('single', self.user), ['wine'])
+
+        client = APIClient()
+        client.force_authenticate(self.runner)
+        pending = [submission['name'] for submission in client.get('/api/pending_submissions/wine/').data['results']]
+        self.assertEqual(pending, self.claim_order())
+
+    def test_reverify(self):
+        submission = self.upload('backfill')
+        Job.objects.bulk_create(Job.plan('wine', [(submission.id, None)], Job.Priority.BACKFILL))
+
+        client = APIClient()
+        client.force_authenticate(self.runner)
+        response = client.post(f'/api/submissions/{submission.id}/reverify/', {'os': ['wine']}, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(submission.jobs.get().priority, Job.Priority.REVERIFY)
+
+        client.force_authenticate(self.user)
+        response = client.post(f'/api/submissions/{submission.id}/reverify/', {'os': ['wine']}, format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_parked_after_max_attempts(self):
+        submission = self.upload('unparseable')
+        Job.enqueue(submission, ['wine'])
+        for _ in range(settings.JOB_MAX_ATTEMPTS):
+            self.assertEqual(self.claim_order(), ['unparseable.rec'])
+            # The lease runs out without a run being recorded
+            Job.objects.update(available_date=timezone.now())
+        self.assertEqual(self.claim_order(), [])
+
+        client = APIClient()
+        client.force_authenticate(self.runner)
+        self.assertEqual(client.get('/api/pending_submissions/wine/').data['results'], [])
+
+        # Reverifying gives it another go
+        Job.enqueue(submission, ['wine'], Job.Priority.REVERIFY)
+        self.assertEqual(self.claim_order(), ['unparseable.rec'])
+
+    def test_lease_token(self):
+        Job.enqueue(self.upload('leased'), ['wine'])
+        client = APIClient()
+        client.force_authenticate(self.runner)
+        stale = client.post('/api/jobs/claim/wine/', {'count': 1}, format='json').data[0]
+        self.assertIsNotNone(stale['lease_token'])
+
+        # Another runner process on the same account claims it once the lease runs out
+        Job.objects.update(available_date=timezone.now())
+        current = client.post('/api/jobs/claim/wine/', {'count': 1}, format='json').data[0]
+        url = f'/api/jobs/{current["id"]}'
+
+        self.assertEqual(client.post(f'{url}/renew/', format='json').status_code, 400)
+        self.assertEqual(client.post(f'{url}/renew/', {'lease_token': stale['lease_token']}, format='json').status_code, 404)
+        self.assertEqual(client.post(f'{url}/release/', {'lease_token': stale['lease_token']}, format='json').status_code, 404)
+        self.assertEqual(Job.objects.get().lease_token, current['lease_token'])
+
+        self.assertEqual(client.post(f'{url}/renew/', {'lease_token': current['lease_token']}, format='json').status_code, 200)
+        self.assertEqual(client.post(f'{url}/release/', {'lease_token': current['lease_token']}, format='json').status_code, 204)
+        self.assertIsNone(Job.objects.get().lease_token)
+
+
+class CampaignTests(TestCase):
+    submission_count = 10
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.runner = User.objects.create_superuser('runner', 'runner@example.com', 'password')
+        runs = []
+        for i in range(cls.submission_count):
+            submission = Submission.objects.create(file=f'uploads/{i}.rec', name=f'Elevator_{i}.rec', hash=f'{i}')
+            runs.append(Run(submission=submission, os='windows', score=make_score(3000)))
+        Run.record(runs)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.runner)
+
+    def claim(self, count):
+        return self.client.post('/api/jobs/claim/windows-new/', {'count': count}, format='json').data
+
+    def run_jobs(self, jobs, score_time=3000):
+        runs = [Run(submission_id=job['submission']['id'], os='windows-new', score=make_score(score_time)) for job in jobs]
+        with self.captureOnCommitCallbacks(execute=True):
+            Run.record(runs)
+
+    def test_campaign(self):
+        response = self.client.post('/api/campaigns/', {'name': 'New physics', 'os': 'windows-new', 'baseline_os': 'windows',
+                                                        'max_pending': 3}, format='json')
+        self.assertEqual(response.status_code, 201)
+        campaign = Campaign.objects.get()
+        self.assertEqual(campaign.total, self.submission_count)
+
+        # Never more than max_pending queued at once
+        jobs = self.claim(2)
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(campaign.jobs.count(), 3)
+
+        # Claimed jobs are still run while paused
+        campaign.pause()
+        self.assertEqual(campaign.jobs.count(), 2)
+        self.assertEqual(self.claim(2), [])
+        self.run_jobs(jobs[:1], 3001)
+        self.run_jobs(jobs[1:])
+        campaign.resume()
+        while True:
+            jobs = self.claim(3)
+            if len(jobs) == 0:
+                break
+            self.run_jobs(jobs)
+        self.claim(1)
+
+        campaign.refresh_from_db()
+        self.assertEqual(campaign.status, Campaign.Status.COMPLETE)
+        progress = campaign.progress()
+        self.assertEqual((progress['done'], progress['remaining']), (self.submission_count, 0))
+        report = self.client.get(f'/api/campaigns/{campaign.id}/report/').data
+        self.assertEqual(report['compared'], self.submission_count)
+        self.assertEqual(report['score']['count'], 1)
+
+    def test_rate_limit(self):
+        campaign = Campaign.objects.create(name='Slow', os='windows-new', baseline_os='windows', rate_limit=2, max_pending=3)
+        self.run_jobs(self.claim(3))
+        self.assertEqual(self.claim(3), [])
+
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + datetime.timedelta(hours=1)):
+            campaign.refresh_from_db()
+            campaign.top_up()
+        self.assertEqual(campaign.jobs.count(), 2)
+
+
+# views reads RecTester.settings directly, which override_settings doesn't reach
+@mock.patch('RecTester.settings.SENDFILE_MODE', None)
+class DownloadTests(TestCase):
+    content = bytes(range(100))
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overridden = override_settings(MEDIA_ROOT=media.name)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+        self.submission = Submission.objects.create(name='Elevator.rec', hash='a' * 64)
+        self.submission.file.save(f'{"a" * 64}.rec', ContentFile(self.content))
+        self.url = f'/submissions/{self.submission.id}/download'
+        self.etag = f'"{"a" * 64}"'
+
+    def get(self, **headers):
+        response = self.client.get(self.url, **headers)
+        return response, b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_whole_file(self):
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+        self.assertEqual(response['ETag'], self.etag)
+
+    def test_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+
+    def test_suffix_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[-5:])
+        self.assertEqual(response['Content-Range'], 'bytes 95-99/100')
+
+    def test_unsatisfiable_range(self):
+        response, _ = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_if_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+
+        response, _ = self.get(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=self.etag)
+        self.assertEqual(response.status_code, 206)
+
+    def test_if_none_match(self):
+        response, body = self.get(HTTP_IF_NONE_MATCH=f'"stale", W/{self.etag}')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(body, b'')
+        self.assertEqual(response['ETag'], self.etag)
+
+
+class ImportTests(TestCase):
+    made = datetime.datetime(2015, 6, 1, 12, 30, tzinfo=datetime.timezone.utc)
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        uploads = tempfile.TemporaryDirectory()
+        self.addCleanup(uploads.cleanup)
+        overridden = override_settings(UPLOADS_PATH=uploads.name)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+    def import_recs(self, path):
+        call_command('import_recs', path, workers=1, os=[], stdout=io.StringIO())
+        return Submission.objects.get()
+
+    def test_dated_by_file(self):
+        path = os.path.join(self.directory.name, 'Elevator.rec')
+        with open(path, 'wb') as f:
+            f.write(b'rec')
+        os.utime(path, (self.made.timestamp(), self.made.timestamp()))
+        self.assertEqual(self.import_recs(self.directory.name).upload_date, self.made)
+
+    def test_dated_by_zip_member(self):
+        path = os.path.join(self.directory.name, 'recs.zip')
+        local = self.made.astimezone()
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr(zipfile.ZipInfo('recs/Elevator.rec', local.timetuple()[:6]), b'rec')
+        self.assertEqual(self.import_recs(path).upload_date, self.made)
+
+
+@override_settings(MIDDLEWARE=['recapp.middleware.MetricsMiddleware'] + settings.MIDDLEWARE)
+class MetricsTests(TestCase):
+    def setUp(self):
+        middleware.reset()
+        self.staff = User.objects.create_superuser('staff', 'staff@example.com', 'password')
+
+    def test_records_per_view(self):
+        self.client.get('/best')
+        metrics = middleware.snapshot()
+        self.assertEqual(metrics['recapp:best']['queries']['count'], 1)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=0)
+    def test_slow_requests(self):
+        with self.assertLogs('recapp.slow_requests', 'WARNING') as logs:
+            self.client.get('/best')
+        self.assertIn('Slow request: GET /best (recapp:best)', logs.output[0])
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=None)
+    def test_slow_requests_disabled(self):
+        with mock.patch.object(middleware.slow_logger, 'warning') as warning:
+            self.client.get('/best')
+        warning.assert_not_called()
+
+    def test_staff_only(self):
+        self.assertIn(self.client.get('/metrics').status_code, [401, 403])
+        self.client.force_login(self.staff)
+        self.client.get('/best')
+        response = self.client.get('/metrics?format=prometheus')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'recapp_queries_count{view="recapp:best"} 1', response.content)
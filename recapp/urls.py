@@ -10,8 +10,11 @@ urlpatterns = [
     path('discrepancies', views.discrepancies, name='discrepancies'),
     path('best', views.best, name='best'),
     path('worst', views.worst, name='worst'),
+    path('desyncs', views.desyncs, name='desyncs'),
     path('submissions', views.index),
     path('submissions/<int:pk>', views.detail, name='detail'),
     path('submissions/<int:pk>/download', views.download, name='download'),
-    path('upload/', views.upload, name='upload')
+    path('submissions/<int:pk>/status', views.status, name='status'),
+    path('upload/', views.upload, name='upload'),
+    path('metrics', views.metrics, name='metrics'),
 ]
@@ -1,146 +1,53 @@
+import base64
+import binascii
 import json
+import os
 import re
 import datetime
 from pprint import pprint
 
 import hashlib
+import itertools
 from django.contrib.auth.models import User, Group
 from django.core.files.uploadedfile import UploadedFile
-from django.db import connection
-from django.db.models import Count, Q
-from django.http import HttpResponse, Http404, FileResponse, HttpResponseBadRequest, HttpResponseRedirect
+from django.db.models import Count, F, Max, Q, Prefetch, Subquery
+from django.http import HttpResponse, JsonResponse, Http404, FileResponse, HttpResponseBadRequest, HttpResponseRedirect, \
+    HttpResponseNotModified, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.dateparse import parse_datetime
 from django.utils.http import urlencode
 from django.views import generic
-from rest_framework import viewsets, permissions
+from rest_framework import viewsets, permissions, mixins
 
 # Create your views here.
 from rest_framework import generics
-from rest_framework.decorators import action, renderer_classes, api_view
-from rest_framework.exceptions import NotFound
+from rest_framework.decorators import action, renderer_classes, api_view, permission_classes
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.pagination import CursorPagination, LimitOffsetPagination
-from rest_framework.renderers import TemplateHTMLRenderer, JSONRenderer
+from rest_framework.renderers import TemplateHTMLRenderer, JSONRenderer, BaseRenderer
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 from RecTester import settings
-from recapp.models import Score, Submission, Run, guess_time
+from recapp import caching, export, middleware
+from recapp.models import Score, Submission, Run, Discrepancy, Job, RunnerHeartbeat, Campaign
 from recapp.permissions import SubmissionPermissions
-from recapp.serializers import SubmissionSerializer, UserSerializer, GroupSerializer, ScoreSerializer, RunSerializer
-
-
-def difference_count(os_one, os_two, include_error=True):
-    if include_error:
-        query = f'''SELECT COUNT(*)
-        FROM (SELECT *
-              FROM recapp_score score1
-                       JOIN
-                   recapp_run run1
-                   ON score1.id = run1.score_id
-              WHERE run1.os == %s) run1
-                 JOIN
-             (SELECT *
-              FROM recapp_score score2
-                       JOIN
-                   recapp_run run2
-                   ON score2.id = run2.score_id
-              WHERE run2.os == %s) run2
-             ON run1.submission_id == run2.submission_id
-                 JOIN recapp_submission sub ON run1.submission_id == sub.id
-        WHERE run1.error != run2.error
-           OR run1.success != run2.success
-           OR run1.score_time != run2.score_time
-           OR run1.elapsed_time != run2.elapsed_time
-           OR run1.bonus_time != run2.bonus_time
-       '''
-    else:
-        query = f'''SELECT COUNT(*)
-            FROM (SELECT *
-                  FROM recapp_score score1
-                           JOIN
-                       recapp_run run1
-                       ON score1.id = run1.score_id
-                  WHERE run1.os == %s) run1
-                     JOIN
-                 (SELECT *
-                  FROM recapp_score score2
-                           JOIN
-                       recapp_run run2
-                       ON score2.id = run2.score_id
-                  WHERE run2.os == %s) run2
-                 ON run1.submission_id == run2.submission_id
-                     JOIN recapp_submission sub ON run1.submission_id == sub.id
-            WHERE run1.error IS NULL
-              AND run2.error IS NULL
-              AND run1.success
-              AND run2.success
-              AND (
-                        run1.score_time != run2.score_time
-                    OR run1.elapsed_time != run2.elapsed_time
-                    OR run1.bonus_time != run2.bonus_time
-                )
-            '''
-    with connection.cursor() as cursor:
-        cursor.execute(query, [os_one, os_two])
-        return cursor.fetchone()[0]
+from recapp.retry import retry_on_lock
+from recapp.serializers import SubmissionSerializer, UserSerializer, GroupSerializer, ScoreSerializer, RunSerializer, RunBatchItemSerializer, JobSerializer, \
+    RunnerHeartbeatSerializer, CampaignSerializer
 
 
 def find_differences(os_one, os_two, include_error=True, order='DESC'):
-    order = 'DESC' if order == 'DESC' else 'ASC'
-    if include_error:
-        query = f'''SELECT sub.*
-        FROM (SELECT *
-              FROM recapp_score score1
-                       JOIN
-                   recapp_run run1
-                   ON score1.id = run1.score_id
-              WHERE run1.os == %s) run1
-                 JOIN
-             (SELECT *
-              FROM recapp_score score2
-                       JOIN
-                   recapp_run run2
-                   ON score2.id = run2.score_id
-              WHERE run2.os == %s) run2
-             ON run1.submission_id == run2.submission_id
-                 JOIN recapp_submission sub ON run1.submission_id == sub.id
-        WHERE run1.error != run2.error
-           OR run1.success != run2.success
-           OR run1.score_time != run2.score_time
-           OR run1.elapsed_time != run2.elapsed_time
-           OR run1.bonus_time != run2.bonus_time
-       ORDER BY sub.upload_date {order}
-       '''
-    else:
-        query = f'''SELECT sub.*
-            FROM (SELECT *
-                  FROM recapp_score score1
-                           JOIN
-                       recapp_run run1
-                       ON score1.id = run1.score_id
-                  WHERE run1.os == %s) run1
-                     JOIN
-                 (SELECT *
-                  FROM recapp_score score2
-                           JOIN
-                       recapp_run run2
-                       ON score2.id = run2.score_id
-                  WHERE run2.os == %s) run2
-                 ON run1.submission_id == run2.submission_id
-                     JOIN recapp_submission sub ON run1.submission_id == sub.id
-            WHERE run1.error IS NULL
-              AND run2.error IS NULL
-              AND run1.success
-              AND run2.success
-              AND (
-                        run1.score_time != run2.score_time
-                    OR run1.elapsed_time != run2.elapsed_time
-                    OR run1.bonus_time != run2.bonus_time
-                )
-            ORDER BY sub.upload_date {order}
-            '''
-    for s in Submission.objects.raw(query, [os_one, os_two]).iterator():
-        yield [r for r in s.runs.all() if r.os == os_one][0], [r for r in s.runs.all() if r.os == os_two][0]
+    kind = Discrepancy.Kind.ANY if include_error else Discrepancy.Kind.SCORE
+    ordering = ['-upload_date', '-id'] if order == 'DESC' else ['upload_date', 'id']
+    differences = Discrepancy.between(os_one, os_two, kind) \
+        .select_related('run_a__submission', 'run_a__score', 'run_b__score') \
+        .order_by(*ordering)
+    for difference in differences.iterator():
+        yield difference.oriented(os_one)
 
 
 def first_n(n, scores):
@@ -152,17 +59,6 @@ def first_n(n, scores):
             break
 
 
-def first_n_offset(n, offset, scores):
-    i = 0
-    for score in scores:
-        i += 1
-        if i < offset:
-            continue
-        yield score
-        if i == n + offset:
-            break
-
-
 def first_n_unique(n, scores):
     i = 0
     seen = set()
@@ -176,44 +72,50 @@ def first_n_unique(n, scores):
             break
 
 
-last_check = {}
+def best_scores(n):
+    submissions = Submission.objects.filter(best_score_time__isnull=False) \
+        .select_related('best_run__score', 'best_run__submission') \
+        .order_by('best_score_time')[:n]
+    return [submission.best_run.score for submission in submissions]
 
 
-def index(request):
-    if request.method != 'GET':
-        return HttpResponseBadRequest()
+def dashboard():
     latest_count = 10
-    latest_submissions = first_n(latest_count, Submission.objects.order_by('-upload_date'))
-    latest_runs = first_n(latest_count, Score.objects.order_by('-run__run_date'))
+    latest_submissions = first_n(latest_count, Submission.objects.select_related('best_run__score', 'best_run__submission').order_by('-upload_date'))
+    latest_runs = first_n(latest_count, Score.objects.select_related('run__submission').order_by('-run__run_date'))
 
-    fastest_scores = first_n_unique(5, Score.objects.filter(Q(run__submission__isnull=False, success=True)).order_by('score_time'))
-    fastest_realtime = first_n_unique(5, Score.objects.filter(Q(run__submission__isnull=False, success=True)).order_by('elapsed_time'))
-    highest_fps = first_n_unique(5, Score.objects.filter(Q(run__submission__isnull=False, success=True, run__submission__is_tas=False)).order_by('-fps'))
-    slowest_scores = first_n_unique(5, Score.objects.filter(Q(run__submission__isnull=False, success=True)).order_by('-score_time'))
-    slowest_realtime = first_n_unique(5, Score.objects.filter(Q(run__submission__isnull=False, success=True)).order_by('-elapsed_time'))
-    lowest_fps = first_n_unique(5, Score.objects.filter(Q(run__submission__isnull=False, success=True)).order_by('fps'))
+    fastest_scores = best_scores(5)
+    fastest_realtime = first_n_unique(5, Score.objects.select_related('run__submission').filter(Q(run__submission__isnull=False, success=True)).order_by('elapsed_time'))
+    highest_fps = first_n_unique(5, Score.objects.select_related('run__submission').filter(Q(run__submission__isnull=False, success=True, run__submission__is_tas=False)).order_by('-fps'))
+    slowest_scores = first_n_unique(5, Score.objects.select_related('run__submission').filter(Q(run__submission__isnull=False, success=True)).order_by('-score_time'))
+    slowest_realtime = first_n_unique(5, Score.objects.select_related('run__submission').filter(Q(run__submission__isnull=False, success=True)).order_by('-elapsed_time'))
+    lowest_fps = first_n_unique(5, Score.objects.select_related('run__submission').filter(Q(run__submission__isnull=False, success=True)).order_by('fps'))
 
     problem_children = first_n(5, find_differences('windows-newphys221029', 'windows'))
     mac_win_diff = first_n(5, find_differences('windows', 'mac', False))
 
-    live_runners = []
-    global last_check
-    for runner, check in last_check.items():
-        if datetime.datetime.now() - check < datetime.timedelta(minutes=30):
-            live_runners.append(runner.username)
+    # Evaluated here so the cached copy holds the results rather than the generators
+    return {
+        'latest_submissions': list(latest_submissions),
+        'latest_runs': list(latest_runs),
+        'fastest_scores': list(fastest_scores),
+        'fastest_realtime': list(fastest_realtime),
+        'highest_fps': list(highest_fps),
+        'slowest_scores': list(slowest_scores),
+        'slowest_realtime': list(slowest_realtime),
+        'lowest_fps': list(lowest_fps),
+        'problem_children': list(problem_children),
+        'mac_win_diff': list(mac_win_diff),
+    }
+
+
+def index(request):
+    if request.method != 'GET':
+        return HttpResponseBadRequest()
 
     return render(request, 'scores/index.html', {
-        'latest_submissions': latest_submissions,
-        'latest_runs': latest_runs,
-        'fastest_scores': fastest_scores,
-        'fastest_realtime': fastest_realtime,
-        'highest_fps': highest_fps,
-        'slowest_scores': slowest_scores,
-        'slowest_realtime': slowest_realtime,
-        'lowest_fps': lowest_fps,
-        'problem_children': problem_children,
-        'mac_win_diff': mac_win_diff,
-        'live_runners': live_runners
+        **caching.cached('dashboard', dashboard),
+        'live_runners': list(RunnerHeartbeat.live())
     })
 
 
@@ -221,7 +123,7 @@ def newest(request):
     if request.method != 'GET':
         return HttpResponseBadRequest()
 
-    latest_submissions = Submission.objects.order_by('-upload_date')[:100]
+    latest_submissions = Submission.objects.select_related('best_run__score', 'best_run__submission').order_by('-upload_date')[:100]
     latest_runs = Score.objects.order_by('-run__run_date')[:100]
 
     return render(request, 'scores/list.html', {
@@ -231,62 +133,154 @@ def newest(request):
     })
 
 
+def encode_cursor(direction, row):
+    return base64.urlsafe_b64encode(f'{direction}{row.upload_date.isoformat()}|{row.id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        date, id = raw[1:].rsplit('|', 1)
+        date = parse_datetime(date)
+        if raw[0] not in 'np' or date is None:
+            raise ValueError
+        return raw[0], date, int(id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        # Keyed by parameter, so the HTML renderer gets a dict to render as well
+        raise ValidationError({'cursor': ['Invalid cursor']})
+
+
+def keyset_page(queryset, cursor, limit):
+    """
+    One page of queryset in (upload_date, id) order, following (or, for a previous-page
+    cursor, preceding) the row the cursor was made from. Seeking to the cursor happens in
+    the query, so a deep page costs the same as the first one.
+    Returns (rows, next page cursor, previous page cursor).
+    """
+    direction, date, id = decode_cursor(cursor) if cursor else ('n', None, None)
+    if direction == 'n':
+        if date is not None:
+            # The redundant bound lets the (..., upload_date) index narrow the scan
+            queryset = queryset.filter(upload_date__gte=date).filter(Q(upload_date__gt=date) | Q(id__gt=id))
+        rows = list(queryset.order_by('upload_date', 'id')[:limit + 1])
+        more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_cursor('n', rows[-1]) if more else None
+        previous_cursor = encode_cursor('p', rows[0]) if date is not None and len(rows) > 0 else None
+    else:
+        queryset = queryset.filter(upload_date__lte=date).filter(Q(upload_date__lt=date) | Q(id__lt=id))
+        rows = list(queryset.order_by('-upload_date', '-id')[:limit + 1])
+        more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        next_cursor = encode_cursor('n', rows[-1]) if len(rows) > 0 else None
+        previous_cursor = encode_cursor('p', rows[0]) if more else None
+    return rows, next_cursor, previous_cursor
+
+
+def compact_run(run):
+    score = run.score
+    return {
+        'run': run.id,
+        'success': None if score is None else score.success,
+        'score_time': None if score is None else score.score_time,
+        'elapsed_time': None if score is None else score.elapsed_time,
+        'bonus_time': None if score is None else score.bonus_time,
+        'gem_count': None if score is None else score.gem_count,
+        'gem_total': None if score is None else score.gem_total,
+        'desync': None if score is None else score.desync,
+        'error': run.error is not None,
+        'error_kind': run.error_kind,
+    }
+
+
 @api_view(['GET'])
 @renderer_classes([TemplateHTMLRenderer, JSONRenderer])
 def compare(request, os1, os2):
     if request.method != 'GET':
         return HttpResponseBadRequest()
 
-    count = difference_count(os1, os2)
+    differences = Discrepancy.between(os1, os2, Discrepancy.Kind.ANY) \
+        .select_related('run_a__submission', 'run_a__score', 'run_b__score')
+    page, next_cursor, previous_cursor = keyset_page(differences, request.query_params.get('cursor'), 100)
+    differences = [difference.oriented(os1) for difference in page]
 
-    offset = int(request.GET.get('offset', '0'))
-    limit = 100
-    pages = []
-    for (i, off) in enumerate(range(0, count, limit)):
-        pages.append((off, i + 1))
+    url = request.build_absolute_uri()
+    links = {
+        'next': None if next_cursor is None else replace_query_param(url, 'cursor', next_cursor),
+        'previous': None if previous_cursor is None else replace_query_param(url, 'cursor', previous_cursor),
+    }
 
-    differences = find_differences(os1, os2, order='ASC')
     if request.accepted_renderer.format == 'html':
-        os1 = os1[0].upper() + os1[1:]
-        os2 = os2[0].upper() + os2[1:]
-
         return Response({
             'list_name': 'compare',
-            'differences': list(first_n_offset(limit, offset, differences)),
-            'os1': os1,
-            'os2': os2,
-            'pages': pages
+            'differences': differences,
+            'os1': os1[0].upper() + os1[1:],
+            'os2': os2[0].upper() + os2[1:],
+            **links,
         }, template_name='scores/list.html')
     else:
-        subs = [r[0].submission for r in list(differences)]
-        serializer = SubmissionSerializer(data=subs, many=True, context={'request': request})
-        serializer.is_valid()
-        data = serializer.data
-        return Response(data)
+        return Response({
+            **links,
+            'results': [{
+                'id': run_one.submission.id,
+                'name': run_one.submission.name,
+                'upload_date': run_one.submission.upload_date,
+                os1: compact_run(run_one),
+                os2: compact_run(run_two),
+            } for run_one, run_two in differences],
+        })
+
+
+def discrepancy_matrix():
+    """Mismatch counts of every pair of OS labels that have runs, from one grouped query over the discrepancy table."""
+    oses = sorted(Run.objects.values_list('os', flat=True).distinct())
+    counts = {}
+    for row in Discrepancy.objects.values('os_a', 'os_b', 'kind').annotate(count=Count('id')):
+        counts[(row['os_a'], row['os_b'], row['kind'])] = row['count']
+
+    return {
+        'oses': oses,
+        'pairs': [{
+            'os_a': os_a,
+            'os_b': os_b,
+            'any': counts.get((os_a, os_b, Discrepancy.Kind.ANY), 0),
+            'score': counts.get((os_a, os_b, Discrepancy.Kind.SCORE), 0),
+        } for os_a, os_b in itertools.combinations(oses, 2)],
+    }
 
 
+@api_view(['GET'])
+@renderer_classes([TemplateHTMLRenderer, JSONRenderer])
 def discrepancies(request):
     if request.method != 'GET':
         return HttpResponseBadRequest()
 
-    categories = [
-        ('Mac vs Windows', 'mac', 'windows'),
-        ('Newphys Broken (2022-02-06)', 'windows', 'windows-newphys220206'),
-        ('Newphys Broken (2022-10-29)', 'windows', 'windows-newphys221029'),
+    matrix = caching.cached('discrepancy_matrix', discrepancy_matrix)
+    if request.accepted_renderer.format != 'html':
+        return Response(matrix)
+
+    # Pairs are stored once, with os_a < os_b, and shown on both sides of the diagonal
+    pairs = {}
+    for pair in matrix['pairs']:
+        pairs[(pair['os_a'], pair['os_b'])] = pair
+        pairs[(pair['os_b'], pair['os_a'])] = pair
+    rows = [
+        (os_one, [(os_two, pairs.get((os_one, os_two))) for os_two in matrix['oses']])
+        for os_one in matrix['oses']
     ]
-
-    return render(request, 'scores/discrepancies.html', {
-        'categories': categories,
-    })
+    return Response({
+        'oses': matrix['oses'],
+        'rows': rows,
+    }, template_name='scores/discrepancies.html')
 
 
 def best(request):
     if request.method != 'GET':
         return HttpResponseBadRequest()
 
-    fastest_scores = first_n_unique(100, Score.objects.filter(Q(run__submission__isnull=False, success=True)).order_by('score_time'))
-    fastest_realtime = first_n_unique(100, Score.objects.filter(Q(run__submission__isnull=False, success=True)).order_by('elapsed_time'))
-    highest_fps = first_n_unique(100, Score.objects.filter(Q(run__submission__isnull=False, success=True, run__submission__is_tas=False)).order_by('-fps'))
+    fastest_scores = best_scores(100)
+    fastest_realtime = first_n_unique(100, Score.objects.select_related('run__submission').filter(Q(run__submission__isnull=False, success=True)).order_by('elapsed_time'))
+    highest_fps = first_n_unique(100, Score.objects.select_related('run__submission').filter(Q(run__submission__isnull=False, success=True, run__submission__is_tas=False)).order_by('-fps'))
 
     return render(request, 'scores/list.html', {
         'list_name': 'best',
@@ -300,9 +294,9 @@ def worst(request):
     if request.method != 'GET':
         return HttpResponseBadRequest()
 
-    slowest_scores = first_n_unique(100, Score.objects.filter(Q(run__submission__isnull=False, success=True)).order_by('-score_time'))
-    slowest_realtime = first_n_unique(100, Score.objects.filter(Q(run__submission__isnull=False, success=True)).order_by('-elapsed_time'))
-    lowest_fps = first_n_unique(100, Score.objects.filter(Q(run__submission__isnull=False, success=True)).order_by('fps'))
+    slowest_scores = first_n_unique(100, Score.objects.select_related('run__submission').filter(Q(run__submission__isnull=False, success=True)).order_by('-score_time'))
+    slowest_realtime = first_n_unique(100, Score.objects.select_related('run__submission').filter(Q(run__submission__isnull=False, success=True)).order_by('-elapsed_time'))
+    lowest_fps = first_n_unique(100, Score.objects.select_related('run__submission').filter(Q(run__submission__isnull=False, success=True)).order_by('fps'))
 
     return render(request, 'scores/list.html', {
         'list_name': 'worst',
@@ -312,28 +306,207 @@ def worst(request):
     })
 
 
+def desyncs(request):
+    if request.method != 'GET':
+        return HttpResponseBadRequest()
+
+    desynced_scores = Score.objects.filter(desync=True).select_related('run__submission').order_by('-run__run_date')[:100]
+
+    return render(request, 'scores/list.html', {
+        'list_name': 'desyncs',
+        'desynced_scores': desynced_scores,
+    })
+
+
 def detail(request, pk):
     if request.method != 'GET':
         return HttpResponseBadRequest()
 
-    submission = get_object_or_404(Submission, id=pk)
+    submission = get_object_or_404(Submission.objects.select_related('best_run__score', 'best_run__submission'), id=pk)
+    runs = list(submission.runs.select_related('score'))
     return render(request, 'scores/detail.html', {
         'submission': submission,
-        'runs': list(submission.runs.all())
+        'runs': runs,
+        # The page watches the status endpoint until every queued run has landed
+        'pending': len(runs) == 0 or submission.jobs.exists(),
     })
 
 
+def status(request, pk):
+    """
+    How far along verification of a submission is, for pages waiting on its runs. The weak
+    ETag changes whenever a run lands or a job is added or taken off the queue, so repeated
+    polls are answered with a bodyless 304.
+    """
+    if request.method != 'GET':
+        return HttpResponseBadRequest()
+
+    runs = Run.objects.filter(submission_id=pk).aggregate(count=Count('id'), last_id=Max('id'))
+    pending = Job.objects.filter(submission_id=pk).count()
+    if runs['count'] == 0 and pending == 0 and not Submission.objects.filter(id=pk).exists():
+        raise Http404
+
+    etag = f'W/"{runs["count"]}-{runs["last_id"] or 0}-{pending}"'
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse({
+            'id': pk,
+            'runs': runs['count'],
+            'last_run': runs['last_id'],
+            'pending': pending,
+        })
+    response['ETag'] = etag
+    # Cacheable, but always revalidated
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
 def download(request, pk):
     if request.method != 'GET':
         return HttpResponseBadRequest()
 
     submission = get_object_or_404(Submission, id=pk)
-    response = FileResponse(submission.file.open('rb'), content_type='application/octet-stream')
-    response['Content-Length'] = submission.file.size
-    response['Content-Disposition'] = f'attachment; filename="{submission.name}"'
+    return send_submission_file(request, submission)
+
+
+class PrometheusRenderer(BaseRenderer):
+    media_type = 'text/plain'
+    format = 'prometheus'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = renderer_context and renderer_context.get('response')
+        if response is not None and response.exception:
+            return str(data)
+        return middleware.prometheus_text(data)
+
+
+class ExportRenderer(BaseRenderer):
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Exports are streamed by the view, so only errors get here
+        return json.dumps(data).encode()
+
+
+class NDJSONRenderer(ExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class CSVRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+@api_view(['GET'])
+@renderer_classes([JSONRenderer, PrometheusRenderer])
+@permission_classes([permissions.IsAdminUser])
+def metrics(request):
+    return Response(middleware.snapshot())
+
+
+def file_range(handle, start, length, chunk_size=8192):
+    try:
+        handle.seek(start)
+        while length > 0:
+            chunk = handle.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        handle.close()
+
+
+def parse_range(header, size):
+    """
+    Parses a single-range "bytes=" Range header into (start, end) inclusive.
+    Returns None to serve the whole file, or False if the range can't be satisfied.
+    """
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header)
+    if match is None or match.group(1) == match.group(2) == '':
+        # Malformed or multiple ranges, which we're allowed to ignore
+        return None
+    if match.group(1) == '':
+        suffix = int(match.group(2))
+        if suffix == 0:
+            return False
+        return max(0, size - suffix), size - 1
+    start = int(match.group(1))
+    end = size - 1 if match.group(2) == '' else min(int(match.group(2)), size - 1)
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def prefetch_runs(queryset, path='runs'):
+    """Fetches the runs (and scores) of every submission in queryset in one extra query, for SubmissionSerializer."""
+    return queryset.prefetch_related(Prefetch(path, queryset=Run.objects.select_related('score')))
+
+
+def etag_matches(request, etag):
+    """Whether the request's If-None-Match header lists etag, compared weakly as that header requires."""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    strip = lambda tag: tag[2:] if tag.startswith('W/') else tag
+    return '*' in tags or strip(etag) in [strip(tag) for tag in tags]
+
+
+def send_submission_file(request, submission):
+    """
+    Responds with a submission's rec file. Files are stored by their hash and never change,
+    so the hash is a strong ETag and responses can be cached for good.
+    """
+    etag = f'"{submission.hash}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'public, max-age=31536000, immutable',
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f'attachment; filename="{submission.name}"',
+    }
+
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    if settings.SENDFILE_MODE is not None:
+        # The proxy reads the file itself, and deals with Range requests
+        response = HttpResponse(content_type='application/octet-stream')
+        if settings.SENDFILE_MODE == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = f'{settings.SENDFILE_URL}/{submission.file_name()}'
+        else:
+            response['X-Sendfile'] = os.path.abspath(submission.file.path)
+    else:
+        size = submission.file.size
+        byte_range = None
+        if 'HTTP_RANGE' in request.META and request.META.get('HTTP_IF_RANGE', etag) == etag:
+            byte_range = parse_range(request.META['HTTP_RANGE'], size)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+        elif byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(file_range(submission.file.open('rb'), start, end - start + 1),
+                                             status=206, content_type='application/octet-stream')
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        else:
+            response = FileResponse(submission.file.open('rb'), content_type='application/octet-stream')
+            response['Content-Length'] = size
+
+    for header, value in headers.items():
+        response[header] = value
     return response
 
 
+@retry_on_lock
 def upload(request):
     if request.method != 'POST':
         return render(request, 'scores/upload.html', {
@@ -354,17 +527,74 @@ def upload(request):
     sub = Submission.create_or_find({
         'file': request.FILES['rec'],
         'is_tas': request.POST.get('tas', 'off') == 'on',
-        'expected_time': expected_time
+        'expected_time': expected_time,
+        'uploader': request.user if request.user.is_authenticated else None,
     })
 
-    if expected_time is None:
-        sub.expected_time = guess_time(sub)
-        sub.save()
-
     return HttpResponseRedirect(reverse('recapp:detail', args=[sub.id]))
 
 
-class SubmissionViewSet(viewsets.ModelViewSet):
+class ConditionalSubmissionMixin:
+    """
+    Answers list and retrieve requests for submissions with a weak ETag, worked out from one
+    aggregate over what is in scope, see state. Clients whose copy is still current get a 304
+    before anything is fetched or serialized. There is no Last-Modified: the latest of some
+    dates can't tell that a row was deleted, or changed twice within a second.
+    """
+
+    def state(self, queryset):
+        """Aggregates that change whenever the response would, or None to answer without an ETag."""
+        # A fresh queryset over the same ids, so filters on runs don't narrow the runs counted here
+        state = Submission.objects.filter(id__in=queryset.values('id')).aggregate(
+            submission_count=Count('id', distinct=True),
+            last_upload=Max('upload_date'),
+            # Edits that leave every count alone, like the derived fields or the admin
+            last_update=Max('updated_date'),
+            verified_count=Count('best_run', distinct=True),
+            run_count=Count('runs', distinct=True),
+            last_run_id=Max('runs__id'),
+        )
+        if state['submission_count'] == 0:
+            return None
+        return state
+
+    def conditional(self, queryset, respond):
+        state = self.state(queryset)
+        if state is None:
+            return respond()
+
+        # Anonymous users are served shorter pages of the same URL
+        fingerprint = repr((sorted(state.items()), self.request.user.is_authenticated))
+        etag = f'W/"{hashlib.sha1(fingerprint.encode()).hexdigest()}"'
+        response = get_conditional_response(self.request, etag=etag)
+        if response is None:
+            response = respond()
+        response['ETag'] = etag
+        patch_vary_headers(response, ['Authorization', 'Cookie'])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        def respond():
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                return self.get_paginated_response(self.get_serializer(page, many=True).data)
+            return Response(self.get_serializer(queryset, many=True).data)
+
+        return self.conditional(queryset, respond)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            queryset = self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: kwargs[lookup_url_kwarg]})
+        except (TypeError, ValueError):
+            # Not a valid id, get_object turns that into a 404
+            return super().retrieve(request, *args, **kwargs)
+        return self.conditional(queryset, lambda: super(ConditionalSubmissionMixin, self).retrieve(request, *args, **kwargs))
+
+
+class SubmissionViewSet(ConditionalSubmissionMixin, viewsets.ModelViewSet):
 
     class SubmissionPagination(LimitOffsetPagination):
         ordering = '-upload_date'
@@ -375,26 +605,61 @@ class SubmissionViewSet(viewsets.ModelViewSet):
             else:
                 return 5
 
-    queryset = Submission.objects.all().order_by('-upload_date')
+    queryset = prefetch_runs(Submission.objects.all()).order_by('-upload_date')
     serializer_class = SubmissionSerializer
     permission_classes = [SubmissionPermissions]
     pagination_class = SubmissionPagination
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.query_params.get('desync') in ('1', 'true'):
+            queryset = queryset.filter(runs__score__desync=True).distinct()
+        return queryset
+
+    def perform_create(self, serializer):
+        serializer.save(uploader=self.request.user if self.request.user.is_authenticated else None)
+
+    # Anonymous users only get a short page of the list, so they don't get the whole dump either
+    @action(methods=['GET'], detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer],
+            permission_classes=[SubmissionPermissions, permissions.IsAuthenticated])
+    def export(self, request):
+        """
+        Every submission with its runs and scores, streamed as NDJSON (one submission per line)
+        or CSV (one run per row). Filters: os (comma separated), level, from, to, success.
+        """
+        try:
+            filters = export.parse_filters(request.query_params)
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+        format = request.accepted_renderer.format
+        _, content_type = export.FORMATS[format]
+        response = StreamingHttpResponse(export.export(format, **filters), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="submissions.{format}"'
+        return response
+
     @action(methods=['GET'], detail=True)
-    def download(self, *args, **kwargs):
+    def download(self, request, *args, **kwargs):
         instance = self.get_object()
-        handle = instance.file.open()
+        return send_submission_file(request, instance)
 
-        response = FileResponse(handle, content_type='application/octet-stream')
-        response['Content-Length'] = instance.file.size
-        response['Content-Disposition'] = f'attachment; filename="{instance.name}"'
-        return response
+    @action(methods=['POST'], detail=True, permission_classes=[permissions.IsAdminUser])
+    def reverify(self, request, *args, **kwargs):
+        """Queues the submission to be run again on os (a list, or comma separated), or every VERIFIER_OS."""
+        instance = self.get_object()
+        oses = request.data.get('os') or settings.VERIFIER_OS
+        if isinstance(oses, str):
+            oses = oses.split(',')
+        Job.enqueue(instance, oses, Job.Priority.REVERIFY)
+        jobs = instance.jobs.filter(os__in=oses).order_by('os')
+        return Response(JobSerializer(jobs, many=True, context=self.get_serializer_context()).data, status=202)
 
 
-class PendingSubmissionViewSet(viewsets.ReadOnlyModelViewSet):
+class PendingSubmissionViewSet(ConditionalSubmissionMixin, viewsets.ReadOnlyModelViewSet):
 
     class PendingSubmissionPagination(CursorPagination):
-        ordering = 'upload_date'
+        # Claim order, see Job.plan
+        ordering = 'sort_key'
 
     serializer_class = SubmissionSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -402,14 +667,84 @@ class PendingSubmissionViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         if 'os' in self.kwargs:
-            if self.request.user is not None:
-                global last_check
-                last_check[self.request.user] = datetime.datetime.now()
+            if self.request.user.is_authenticated:
+                RunnerHeartbeat.poll(self.request.user, self.kwargs['os'])
 
         # if self.kwargs['os'] not in Run.Platform.values:
         #     raise NotFound
 
-        return Submission.objects.annotate(num_runs=Count('runs', filter=Q(runs__os=self.kwargs['os']))).filter(num_runs=0).order_by('-upload_date')
+        jobs = {f'jobs__{lookup}': value for lookup, value in self.available_jobs().items()}
+        return prefetch_runs(Submission.objects.filter(**jobs)) \
+            .annotate(sort_key=F('jobs__sort_key')).order_by('sort_key')
+
+    def available_jobs(self):
+        """Lookups for the jobs behind the list: on this OS, not leased and not parked."""
+        return {'os': self.kwargs['os'], 'available_date__lte': timezone.now(), 'attempts__lt': settings.JOB_MAX_ATTEMPTS}
+
+    def state(self, queryset):
+        # Only the queue's own rows rather than every queued submission joined to all its runs,
+        # as runners poll this more than anything else
+        return Job.objects.filter(**self.available_jobs()).aggregate(
+            job_count=Count('id'),
+            # A reverify request moves one up the list by replacing its job
+            last_job=Max('id'),
+            # A lease running out puts a submission back on the list without anything else changing
+            last_available=Max('available_date'),
+            # Runs on other OSes show up in the listed submissions; the newest id comes off the primary key
+            last_run_id=Max(Subquery(Run.objects.order_by('-id').values('id')[:1])),
+        )
+
+
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    serializer_class = JobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        # Only the jobs currently leased to the requesting runner
+        return prefetch_runs(Job.objects.filter(lease_owner=self.request.user, available_date__gt=timezone.now()), 'submission__runs') \
+            .select_related('submission').order_by('available_date')
+
+    @action(methods=['POST'], detail=False, url_path='claim/(?P<os>[a-z_0-9-]+)')
+    @retry_on_lock
+    def claim(self, request, os):
+        RunnerHeartbeat.poll(request.user, os)
+
+        try:
+            count = int(request.data.get('count', 1))
+        except (TypeError, ValueError):
+            raise ValidationError('count must be a number')
+        count = max(1, min(count, settings.JOB_CLAIM_LIMIT))
+
+        Campaign.top_up_all(os)
+        jobs = prefetch_runs(Job.claim(os, request.user, count), 'submission__runs').select_related('submission')
+        serializer = self.get_serializer(jobs, many=True)
+        return Response(serializer.data)
+
+    def get_lease_token(self):
+        """The token claim returned with the job, which the lease is checked against rather than the stored row."""
+        lease_token = self.request.data.get('lease_token')
+        if not isinstance(lease_token, str) or lease_token == '':
+            raise ValidationError({'lease_token': ['This field is required.']})
+        return lease_token
+
+    @action(methods=['POST'], detail=True)
+    @retry_on_lock
+    def renew(self, request, pk=None):
+        lease_token = self.get_lease_token()
+        job = self.get_object()
+        RunnerHeartbeat.poll(request.user, job.os)
+        if not job.renew(lease_token):
+            raise NotFound
+        return Response(self.get_serializer(job).data)
+
+    @action(methods=['POST'], detail=True)
+    @retry_on_lock
+    def release(self, request, pk=None):
+        lease_token = self.get_lease_token()
+        job = self.get_object()
+        if not job.release(lease_token):
+            raise NotFound
+        return Response(status=204)
 
 
 class RunViewSet(viewsets.ModelViewSet):
@@ -426,7 +761,7 @@ class RunViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         submission = self.get_submission()
-        return submission.runs.all()
+        return submission.runs.select_related('score')
 
     def get_object(self):
         queryset = self.get_queryset()
@@ -436,13 +771,112 @@ class RunViewSet(viewsets.ModelViewSet):
         except:
             raise NotFound
 
-    def perform_create(self, serializer):
-        if self.request.user is not None:
-            global last_check
-            last_check[self.request.user] = datetime.datetime.now()
+    @retry_on_lock
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
 
+    def perform_create(self, serializer):
         submission = self.get_submission()
-        serializer.save(submission=submission)
+        run = serializer.save(submission=submission)
+        RunnerHeartbeat.add_results(self.request.user, run.os, [run])
+
+
+class RunBatchViewSet(viewsets.GenericViewSet):
+    queryset = Run.objects.none()
+    serializer_class = RunBatchItemSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    @action(methods=['POST'], detail=False)
+    @retry_on_lock
+    def bulk(self, request):
+        """
+        Records many runs, for any number of submissions, in a single transaction.
+        Responds with one status entry per item, in the order they were sent.
+
+        Submissions are looked up in one query for the whole batch. The runs and scores
+        themselves are still inserted row by row on SQLite, where Django can't get primary
+        keys back from a bulk insert, so the saving is one round trip per request rather
+        than one query per run.
+        """
+        if not isinstance(request.data, list):
+            raise ValidationError('Expected a list of runs')
+        if len(request.data) > settings.RUN_BATCH_LIMIT:
+            raise ValidationError(f'At most {settings.RUN_BATCH_LIMIT} runs per batch')
+
+        ids = set()
+        for item in request.data:
+            try:
+                ids.add(int(item['submission']))
+            except (TypeError, ValueError, KeyError):
+                # Left for the serializer to report
+                pass
+        context = {**self.get_serializer_context(), 'submissions': Submission.objects.in_bulk(ids)}
+
+        results = []
+        runs = []
+        for item in request.data:
+            serializer = self.get_serializer_class()(data=item, context=context)
+            if not serializer.is_valid():
+                results.append({'status': 400, 'errors': serializer.errors})
+                continue
+            if not request.user.has_perm('submissions.view_submission', serializer.validated_data['submission']):
+                results.append({'status': 404, 'errors': {'submission': ['Not found.']}})
+                continue
+            run = RunSerializer.build(serializer.validated_data)
+            runs.append(run)
+            results.append({'status': 201, 'run': run})
+
+        Run.record(runs)
+
+        by_os = {}
+        for run in runs:
+            by_os.setdefault(run.os, []).append(run)
+        for os, os_runs in by_os.items():
+            RunnerHeartbeat.add_results(request.user, os, os_runs)
+
+        for result in results:
+            if 'run' in result:
+                result['run'] = self.get_serializer(result['run']).data
+        return Response(results)
+
+
+class RunnerViewSet(viewsets.ReadOnlyModelViewSet):
+    serializer_class = RunnerHeartbeatSerializer
+    permission_classes = [permissions.AllowAny]
+
+    def get_queryset(self):
+        return RunnerHeartbeat.live()
+
+
+class CampaignViewSet(mixins.CreateModelMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Campaign.objects.all().order_by('-created_date')
+    serializer_class = CampaignSerializer
+    permission_classes = [permissions.IsAdminUser]
+
+    @action(methods=['POST'], detail=True)
+    def pause(self, request, pk=None):
+        campaign = self.get_object()
+        if campaign.status != Campaign.Status.ACTIVE:
+            raise ValidationError(f'Campaign is {campaign.status}')
+        campaign.pause()
+        return Response(self.get_serializer(campaign).data)
+
+    @action(methods=['POST'], detail=True)
+    def resume(self, request, pk=None):
+        campaign = self.get_object()
+        if campaign.status != Campaign.Status.PAUSED:
+            raise ValidationError(f'Campaign is {campaign.status}')
+        campaign.resume()
+        return Response(self.get_serializer(campaign).data)
+
+    @action(methods=['GET'], detail=True)
+    def report(self, request, pk=None):
+        """Discrepancies against the baseline OS so far, see Campaign.report."""
+        campaign = self.get_object()
+        return Response({
+            **campaign.report(),
+            'compare_url': request.build_absolute_uri(reverse('recapp:compare', args=[campaign.os, campaign.baseline_os])),
+        })
 
 
 class UserViewSet(viewsets.ModelViewSet):